@@ -1,4 +1,4 @@
-from .cky import CKY
+from .cky import CKY, ExpectedCounts
 from .distributions import (
     StructDistribution,
     LinearChainCRF,
@@ -8,6 +8,7 @@ from .distributions import (
     TreeCRF,
     SentCFG,
     AlignmentCRF,
+    CTCCRF,
     HMM,
 )
 from .autoregressive import Autoregressive, AutoregressiveModel
@@ -16,9 +17,11 @@ from .deptree import DepTree
 from .linearchain import LinearChain
 from .semimarkov import SemiMarkov
 from .alignment import Alignment
+from .ctc import CTC
 from .rl import SelfCritical
 from .semirings import (
     LogSemiring,
+    ScaledSemiring,
     FastLogSemiring,
     TempMax,
     FastMaxSemiring,
@@ -41,10 +44,12 @@ version = "0.4"
 __all__ = [
     CKY,
     CKY_CRF,
+    ExpectedCounts,
     DepTree,
     LinearChain,
     SemiMarkov,
     LogSemiring,
+    ScaledSemiring,
     StdSemiring,
     SampledSemiring,
     MaxSemiring,
@@ -68,6 +73,8 @@ __all__ = [
     HMM,
     AlignmentCRF,
     Alignment,
+    CTCCRF,
+    CTC,
     CheckpointSemiring,
     CheckpointShardSemiring,
     TempMax,
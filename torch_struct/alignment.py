@@ -1,27 +1,88 @@
 import torch
-from .helpers import _Struct
+from .helpers import _Struct, Chart, ChartDP
+import functools
 import math
 
-try:
-    import genbmm
-except ImportError:
-    pass
-
-from .semirings import LogSemiring
+from .semirings import LogSemiring, MaxSemiring
+from .semirings.banded import BandedMatrix, has_genbmm
 from .semirings.fast_semirings import broadcast
 
+if has_genbmm:
+    import genbmm
+
 Down, Mid, Up = 0, 1, 2
 Open, Close = 0, 1
 
 
+@functools.lru_cache(maxsize=64)
+def _rotation(N, M, bin_N, device):
+    """
+    Cell (i, j) of an N x M grid rotated to position i + j and offset
+    j - i + N - 1, and the (z, y) chart indices of the Down / Up merges.
+    """
+    grid_x = torch.arange(N, device=device).view(N, 1).expand(N, M)
+    grid_y = torch.arange(M, device=device).view(1, M).expand(N, M)
+    ind_U = torch.arange(1, bin_N, device=device)
+    ind_D = torch.arange(bin_N - 1, device=device)
+    y = torch.stack([ind_D, ind_U], dim=0)
+    z = torch.stack([torch.full_like(ind_D, 2), torch.zeros_like(ind_U)], dim=0)
+    return grid_x + grid_y, grid_y - grid_x + N - 1, z, y
+
+
+@functools.lru_cache(maxsize=64)
+def _wavefront_index(N, M, lo, hi, device):
+    """
+    Cells (i, j) of an N x M grid on anti-diagonal d = i + j at position
+    j - i - lo, for the offsets lo <= j - i <= hi.
+    """
+    d = torch.arange(N + M - 1, device=device)[:, None]
+    k = torch.arange(lo, hi + 1, device=device)[None, :]
+    i, j = (d - k) // 2, (d + k) // 2
+    valid = ((d - k) % 2 == 0) & (i >= 0) & (i < N) & (j >= 0) & (j < M)
+    d, p = valid.nonzero(as_tuple=True)
+    return d, p, i[d, p], j[d, p]
+
+
 class Alignment(_Struct):
+    """
+    Alignment dynamic program.
+
+    Parameters:
+        semiring : semiring of the DP
+        max_gap : if given, bounds the gaps of the alignments
+        local : local (Smith-Waterman) instead of global alignment
+        engine : "scan" for the parallel linear scan, or "wavefront" for a
+                 sequential sweep over the anti-diagonals i + j. The
+                 wavefront keeps O(M + N) cells per anti-diagonal, or
+                 O(max_gap) for cells with abs(j - i) <= max_gap, and the
+                 chart of all anti-diagonals is kept for the backward:
+                 O((M + N)^2) cells, or O((M + N) max_gap). The local merges
+                 of the scan are exact for max only, local alignment in
+                 other semirings runs on the wavefront.
+        checkpoint : anti-diagonals recomputed together in the backward of
+                     the wavefront (see :class:`ChartDP`)
+
+    Lengths are either *b* lengths of N, or *b x 2* (N, M) lengths of
+    ragged pairs with independent N and M. Ragged pairs are run in buckets
+    of similar size, each cropped to its largest pair.
+    """
+
     def __init__(
-        self, semiring=LogSemiring, sparse_rounds=3, max_gap=None, local=False
+        self,
+        semiring=LogSemiring,
+        sparse_rounds=3,
+        max_gap=None,
+        local=False,
+        engine="scan",
+        checkpoint=1,
     ):
+        assert engine in ("scan", "wavefront"), "Unknown engine"
         self.semiring = semiring
         self.sparse_rounds = sparse_rounds
         self.local = local
         self.max_gap = max_gap
+        self.engine = engine
+        self.checkpoint = checkpoint
 
     def _check_potentials(self, edge, lengths=None):
         batch, N_1, M_1, x = edge.shape
@@ -36,27 +97,128 @@ class Alignment(_Struct):
         N = N_1
         M = M_1
 
-        assert M >= N
-
         if lengths is None:
             lengths = torch.LongTensor([N] * batch)
 
+        if lengths.dim() == 2:
+            assert (lengths[:, 0] <= N).all(), "Length longer than edge scores"
+            assert (lengths[:, 1] <= M).all(), "Length longer than edge scores"
+            return edge, batch, N, M, lengths
+
         assert max(lengths) <= N, "Length longer than edge scores"
         assert max(lengths) == N, "One length must be at least N"
         return edge, batch, N, M, lengths
 
     def _dp(self, log_potentials, lengths=None, force_grad=False):
-        return self._dp_scan(log_potentials, lengths, force_grad)
+        log_potentials.requires_grad_(True)
+        edge, batch, N, M, lengths = self._check_potentials(log_potentials, lengths)
+        lengths = lengths.to(edge.device)
+        wavefront = self.engine == "wavefront" or (
+            self.local and self.semiring is not MaxSemiring
+        )
+        engine = self._dp_wavefront if wavefront else self._dp_scan
+        if lengths.dim() == 1:
+            return engine(edge, lengths, force_grad), [edge], None
+
+        # Ragged pairs: pack them into buckets of similar size, each cropped
+        # to its own largest pair. Both engines read each pair at its own
+        # end cell.
+        key = torch.log2(lengths.sum(-1).float()).ceil().long()
+        vs, order = [], []
+        for k in key.unique().tolist():
+            idx = (key == k).nonzero(as_tuple=True)[0]
+            n, m = lengths[idx].max(0)[0].tolist()
+            vs.append(engine(edge[:, idx, :n, :m], lengths[idx], force_grad))
+            order.append(idx)
+        v = torch.cat(vs, dim=1)[:, torch.cat(order).argsort()]
+        return v, [edge], None
+
+    def _dp_wavefront(self, log_potentials, lengths, force_grad=False):
+        "Compute forward pass by a sweep over the anti-diagonals"
+        semiring = self.semiring
+        _, batch, N, M, _ = log_potentials.shape
+        if lengths.dim() == 1:
+            lengths = torch.stack([lengths, torch.full_like(lengths, M)], dim=-1)
+        ns, ms = lengths[:, 0], lengths[:, 1]
+
+        # Anti-diagonal d = i + j holds the offsets lo <= j - i <= hi.
+        D = N + M - 1
+        lo, hi = -(N - 1), M - 1
+        if self.max_gap is not None:
+            lo, hi = max(lo, -self.max_gap), min(hi, self.max_gap)
+        W = hi - lo + 1
+        assert (ms - ns <= hi).all() and (
+            ns - ms <= -lo
+        ).all(), "Pairs must end within max_gap"
+
+        # Rotate the cells of each pair, cells outside of the pair are zero.
+        d, p, i, j = _wavefront_index(N, M, lo, hi, log_potentials.device)
+        b, v = ((i[None] < ns[:, None]) & (j[None] < ms[:, None])).nonzero(
+            as_tuple=True
+        )
+        rotated = semiring.zero_(
+            log_potentials.new_zeros((log_potentials.shape[0], batch, D, W, 3))
+        )
+        rotated[:, b, d[v], p[v]] = log_potentials[:, b, i[v], j[v]]
+
+        def shift(x, t):
+            # Offset k of the result holds offset k + t of x.
+            pad = semiring.zero_(x[..., : abs(t)].clone())
+            if t > 0:
+                return torch.cat([x[..., t:], pad], -1)
+            return torch.cat([pad, x[..., :t]], -1)
+
+        # alpha[i, j] sums the paths from (0, 0) ending in (i, j), and for
+        # local alignment mid[i, j] those ending in a match at (i, j).
+        alpha = Chart((batch, W, D), log_potentials, semiring)
+        mid = Chart((batch, W, D), log_potentials, semiring) if self.local else None
+
+        def init(rotated):
+            alpha[:, 0] = rotated[:, :, 0, :, Mid]
+            if self.local:
+                mid[:, 0] = rotated[:, :, 0, :, Mid]
+
+        def step(n):
+            def step(rotated):
+                e = rotated[:, :, n]
+                prev = alpha[:, n - 1]
+                st = [
+                    semiring.times(shift(prev, 1), e[..., Up]),
+                    semiring.times(shift(prev, -1), e[..., Down]),
+                ]
+                match = e[..., Mid]
+                if n >= 2:
+                    diag = alpha[:, n - 2]
+                    if self.local:
+                        diag = semiring.plus(semiring.one_(diag.clone()), diag)
+                    match = semiring.times(diag, match)
+                elif not self.local:
+                    match = semiring.zero_(match.clone())
+                st.append(match)
+                if self.local:
+                    mid[:, n] = match
+                alpha[:, n] = semiring.sum(torch.stack(st, dim=-1))
+
+            return step
+
+        def final(rotated):
+            if self.local:
+                v = mid[:, :]
+                return semiring.sum(v.reshape(v.shape[:2] + (-1,)))
+            v = alpha[:, :]
+            ends = torch.arange(batch, device=lengths.device)
+            return v[:, ends, ms - ns - lo, ns + ms - 2]
 
-    def _dp_scan(self, log_potentials, lengths=None, force_grad=False):
+        stages = [init] + [step(n) for n in range(1, D)] + [final]
+        charts = [alpha] + ([mid] if self.local else [])
+        return ChartDP(charts, stages, self.checkpoint)(rotated)
+
+    def _dp_scan(self, log_potentials, lengths, force_grad=False):
         "Compute forward pass by linear scan"
         # Setup
         semiring = self.semiring
-        log_potentials.requires_grad_(True)
         ssize = semiring.size()
-        log_potentials, batch, N, M, lengths = self._check_potentials(
-            log_potentials, lengths
-        )
+        _, batch, N, M, _ = log_potentials.shape
 
         # N is the longer (time) dimension.
         steps = M + N
@@ -78,66 +240,65 @@ class Alignment(_Struct):
         # Init
         # This part is complicated. Rotate the scores by 45% and
         # then compress one.
-        grid_x = torch.arange(N).view(N, 1).expand(N, M)
-        grid_y = torch.arange(M).view(1, M).expand(N, M)
-        rot_x = grid_x + grid_y
-        rot_y = grid_y - grid_x + N - 1
-
-        ind = torch.arange(bin_N)
-        ind_M = ind
-        ind_U = torch.arange(1, bin_N)
-        ind_D = torch.arange(bin_N - 1)
-        for b in range(lengths.shape[0]):
-            # Fill base chart with values.
-            l = lengths[b]
-            charta[0][:, b, rot_x[:l], 0, rot_y[:l], :, :, :] = log_potentials[
-                :, b, :l, :, None, None
-            ]
-
-            # Create finalizing paths.
-            point = (l + M) // 2
-
-            charta[1][:, b, point:, 1, ind, :, :, Mid] = semiring.one_(
-                charta[1][:, b, point:, 1, ind, :, :, Mid]
-            )
-
-        for b in range(lengths.shape[0]):
-            point = (lengths[b] + M) / 2
-            lim = point * 2
-
-            left_ = charta[0][:, b, 0:lim:2, 0]
-            right = charta[0][:, b, 1:lim:2, 0]
-
-            charta[1][:, b, :point, 1, ind_M] = torch.stack(
-                [
-                    left_[..., Down],
-                    semiring.plus(left_[..., Mid], right[..., Mid]),
-                    left_[..., Up],
-                ],
-                dim=-1,
-            )
+        rot_x, rot_y, z, y = _rotation(N, M, bin_N, log_potentials.device)
+        lengths = lengths.to(log_potentials.device)
+        if lengths.dim() == 1:
+            lengths = torch.stack([lengths, torch.full_like(lengths, M)], dim=-1)
+        ns, ms = lengths[:, 0], lengths[:, 1]
+        point = torch.div(ns + ms, 2, rounding_mode="floor")
+
+        # Fill base chart with the cells of each pair.
+        cells = (
+            torch.arange(N, device=lengths.device)[:, None] < ns[:, None, None]
+        ) & (torch.arange(M, device=lengths.device) < ms[:, None, None])
+        b, i, j = cells.nonzero(as_tuple=True)
+        charta[0][:, b, rot_x[i, j], 0, rot_y[i, j], :, :, :] = log_potentials[
+            :, b, i, j, None, None
+        ]
+
+        # Create finalizing paths.
+        P = bin_N // 2
+        pos = torch.arange(P, device=lengths.device)
+        b, p = (pos[None] >= point[:, None]).nonzero(as_tuple=True)
+        charta[1][:, b, p, 1, :, :, :, Mid] = semiring.one_(
+            charta[1][:, b, p, 1, :, :, :, Mid]
+        )
 
-            y = torch.stack([ind_D, ind_U], dim=0)
-            z = y.clone()
-            z[0, :] = 2
-            z[1, :] = 0
-
-            charta[1][:, b, :point, z, y, :, :, :] = torch.stack(
-                [
-                    semiring.times(
-                        left_[:, :, ind_D, Open : Open + 1 :, :],
-                        right[:, :, ind_U, :, Open : Open + 1, Down : Down + 1],
-                    ),
-                    semiring.times(
-                        left_[:, :, ind_U, Open : Open + 1, :, :],
-                        right[:, :, ind_D, :, Open : Open + 1, Up : Up + 1],
-                    ),
-                ],
-                dim=2,
-            )
+        # Merge the first two positions of all pairs at once.
+        left_ = charta[0][:, :, 0::2, 0]
+        right = charta[0][:, :, 1::2, 0]
+        b, p = (pos[None] < point[:, None]).nonzero(as_tuple=True)
+        charta[1][:, b, p, 1] = torch.stack(
+            [
+                left_[:, b, p, ..., Down],
+                semiring.plus(left_[:, b, p, ..., Mid], right[:, b, p, ..., Mid]),
+                left_[:, b, p, ..., Up],
+            ],
+            dim=-1,
+        )
+        left_, right = left_[:, b, p], right[:, b, p]
+        charta[1][:, b[:, None, None], p[:, None, None], z, y] = torch.stack(
+            [
+                semiring.times(
+                    left_[:, :, :-1, Open : Open + 1, :, :],
+                    right[:, :, 1:, :, Open : Open + 1, Down : Down + 1],
+                ),
+                semiring.times(
+                    left_[:, :, 1:, Open : Open + 1, :, :],
+                    right[:, :, :-1, :, Open : Open + 1, Up : Up + 1],
+                ),
+            ],
+            dim=2,
+        )
 
         chart = charta[1][..., :, :, :].permute(0, 1, 2, 5, 6, 7, 4, 3)
 
+        # Banded merges use the genbmm kernels on CUDA when installed, and
+        # the native strided implementation otherwise.
+        band = BandedMatrix
+        if has_genbmm and log_potentials.is_cuda:
+            band = genbmm.BandedMatrix
+
         # Scan
         def merge(x):
             inner = x.shape[-1]
@@ -152,8 +313,8 @@ class Alignment(_Struct):
             st = []
             for op in (Mid, Up, Down):
                 leftb, rightb, _ = broadcast(left, right[..., op, :, :])
-                leftb = genbmm.BandedMatrix(leftb, width, width, semiring.zero)
-                rightb = genbmm.BandedMatrix(rightb, width, width, semiring.zero)
+                leftb = band(leftb, width, width, semiring.zero)
+                rightb = band(rightb, width, width, semiring.zero)
                 leftb = leftb.transpose().col_shift(op - 1).transpose()
                 v = semiring.matmul(rightb, leftb).band_pad(1).band_shift(op - 1)
                 v = v.data.view(ssize, batch, -1, LOC, LOC, 3, bin_N, v.data.shape[-1])
@@ -170,29 +331,127 @@ class Alignment(_Struct):
                     return torch.cat([pads, v, pads], -1)
 
                 left_ = x[:, :, 0::2, Close, None]
-                left_ = pad(left)
+                left_ = pad(left_)
                 right = x[:, :, 1::2, :, Close, None]
                 right = pad(right)
                 st.append(torch.cat([semiring.zero_(left_.clone()), left_], dim=3))
                 st.append(torch.cat([semiring.zero_(right.clone()), right], dim=4))
             return semiring.sum(torch.stack(st, dim=-1))
 
+        # The end cells sit at offsets m - n from the start, which may lie
+        # beyond bin_N / 2 for pairs of very different lengths.
+        half = max(bin_N // 2, int((ms - ns).abs().max()))
         for n in range(2, log_N + 1):
             chart = merge(chart)
 
             center = int((chart.shape[-1] - 1) // 2)
-            if center > (bin_N / 2):
-                chart = chart[..., center - (bin_N // 2) : center + (bin_N // 2) + 1]
+            if center > half:
+                chart = chart[..., center - half : center + half + 1]
             elif self.max_gap is not None and center > self.max_gap:
                 chart = chart[..., center - self.max_gap : center + self.max_gap + 1]
 
         if self.local:
             v = semiring.sum(semiring.sum(chart[..., 0, Close, Close, Mid, :, :]))
         else:
-            v = chart[
-                ..., 0, Open, Open, Mid, N - 1, M - N + ((chart.shape[-1] - 1) // 2)
-            ]
-        return v, [log_potentials], None
+            # Each pair ends at offset m - n from its start cell.
+            ends = torch.arange(batch, device=lengths.device)
+            center = (chart.shape[-1] - 1) // 2
+            v = chart[:, ends, 0, Open, Open, Mid, N - 1, ms - ns + center]
+        return v
+
+    def decode(self, log_potentials, lengths=None):
+        """
+        Best alignment by max-plus dynamic programming with backpointers,
+        without autograd.
+
+        Parameters:
+            log_potentials : b x N x M x 3 scores
+            lengths: None, b lengths of N, or b x 2 (N, M) lengths
+
+        Returns:
+            path : b x (N + M - 1) x 3 long tensor of the (i, j, op) of the
+                   cells of the alignment in order, padded with -1. The
+                   first cell has op Mid.
+            score : b scores of the alignments
+        """
+        with torch.no_grad():
+            batch, N, M, _ = log_potentials.shape
+            device = log_potentials.device
+            if lengths is None:
+                lengths = torch.LongTensor([N] * batch)
+            lengths = lengths.to(device)
+            if lengths.dim() == 1:
+                lengths = torch.stack([lengths, torch.full_like(lengths, M)], -1)
+            ns, ms = lengths[:, 0], lengths[:, 1]
+            inside = (torch.arange(N, device=device)[:, None] < ns[:, None, None]) & (
+                torch.arange(M, device=device) < ms[:, None, None]
+            )
+            e = log_potentials.masked_fill(~inside[..., None], -float("inf"))
+
+            # Best paths ending in cell (i, j) at (i + 1, j + 1), and for local
+            # alignment those ending in a match, with the op entering the cell
+            # and whether the match starts the alignment.
+            best = e.new_full((batch, N + 1, M + 1), -float("inf"))
+            mid = best.clone()
+            back = lengths.new_zeros((batch, N, M))
+            start = torch.zeros_like(inside)
+            for d in range(N + M - 1):
+                i = torch.arange(max(0, d - M + 1), min(N, d + 1), device=device)
+                j = d - i
+                cell = e[:, i, j]
+                match = best[:, i, j]
+                if self.local:
+                    start[:, i, j] = match <= 0
+                    match = cell[..., Mid] + match.clamp(min=0)
+                    mid[:, i + 1, j + 1] = match
+                elif d == 0:
+                    match = cell[..., Mid]
+                else:
+                    match = cell[..., Mid] + match
+                cands = torch.stack(
+                    [
+                        best[:, i + 1, j] + cell[..., Down],
+                        match,
+                        best[:, i, j + 1] + cell[..., Up],
+                    ],
+                    dim=-1,
+                )
+                best[:, i + 1, j + 1], back[:, i, j] = cands.max(-1)
+
+            b = torch.arange(batch, device=device)
+            if self.local:
+                score, end = mid[:, 1:, 1:].reshape(batch, -1).max(-1)
+                i, j = end // M, end % M
+            else:
+                score, i, j = best[b, ns, ms], ns - 1, ms - 1
+
+            # Walk the backpointers to the first cell.
+            in_mid = torch.full_like(b, self.local, dtype=torch.bool)
+            active = torch.ones_like(in_mid)
+            cells = []
+            for _ in range(N + M - 1):
+                if not active.any():
+                    break
+                op = torch.where(in_mid, torch.full_like(i, Mid), back[b, i, j])
+                node = torch.stack([i, j, op], -1)
+                cells.append(node.masked_fill(~active[:, None], -1))
+                if self.local:
+                    first = (op == Mid) & start[b, i, j]
+                else:
+                    first = (i == 0) & (j == 0)
+                active = active & ~first
+                i = i - ((op >= Mid) & active).long()
+                j = j - ((op <= Mid) & active).long()
+                in_mid = torch.zeros_like(in_mid)
+
+            # Reverse the cells of each path.
+            cells = torch.stack(cells, dim=1)
+            size = (cells[..., 0] >= 0).sum(1, keepdim=True)
+            k = torch.arange(N + M - 1, device=device)
+            src = (size - 1 - k).clamp(0, cells.shape[1] - 1)
+            path = cells.gather(1, src[..., None].expand(-1, -1, 3))
+            path = path.masked_fill((k >= size)[..., None], -1)
+            return path, score
 
     @staticmethod
     def _rand(min_n=2):
@@ -1,132 +1,634 @@
 import torch
-from .helpers import _Struct, Chart
+from .helpers import (
+    _Struct,
+    Chart,
+    ChartDP,
+    _Marginals,
+    _span_index,
+    _scatter,
+    _traceback,
+)
+from .semirings import LogSemiring
 
 A, B = 0, 1
 
 
 class CKY(_Struct):
+    """
+    Inside algorithm for a PCFG in Chomsky normal form.
+
+    Parameters:
+        semiring : semiring of the DP
+        checkpoint : widths recomputed together in backward (see :class:`ChartDP`)
+        max_width : if given, only spans of width at most `max_width` are built
+                    by CKY. Longer spans are restricted to the prefixes [0, j),
+                    a left-branching spine of bounded spans closing the tree.
+                    The charts then keep O(N max_width) cells.
+        keep : optional *b x N x N* bool mask of the spans (start, end) to
+               build, or *b x N x N x NT* nonterminal beam of each span, e.g.
+               from :meth:`CKY_CRF.prune`. Width steps only compute the kept
+               spans. Terminal spans are always kept.
+    """
+
+    def __init__(self, semiring=LogSemiring, checkpoint=1, max_width=None, keep=None):
+        super().__init__(semiring, checkpoint)
+        self.max_width = max_width
+        self.keep = keep
+
     def _dp(self, scores, lengths=None, force_grad=False):
 
         semiring = self.semiring
 
         # Checks
         terms, rules, roots = scores
-        rules.requires_grad_(True)
-        ssize = semiring.size()
+        rank = isinstance(rules, tuple) and len(rules) == 3
+        params = self._rule_params(rules)
+        for r in params:
+            r.requires_grad_(True)
         batch, N, T = terms.shape
-        _, NT, _, _ = rules.shape
-        S = NT + T
+        NT = roots.shape[-1]
 
-        terms, rules, roots = (
+        terms, roots = (
             semiring.convert(terms).requires_grad_(True),
-            semiring.convert(rules).requires_grad_(True),
             semiring.convert(roots).requires_grad_(True),
         )
+        rules = self._with_params(
+            rules, [semiring.convert(r).requires_grad_(True) for r in params]
+        )
         if lengths is None:
             lengths = torch.LongTensor([N] * batch)
 
-        # Charts
-        beta = [Chart((batch, N, N, NT), rules, semiring) for _ in range(2)]
-        span = [None for _ in range(N)]
-        v = (ssize, batch)
-        term_use = terms + 0.0
+        # Span potentials (semiring one) of the spans built by the DP: the
+        # bounded spans by (width - 1, start), then the spine spans [0, j)
+        # (see :meth:`_full_spans`). Their gradients are the span marginals.
+        D = N if self.max_width is None else max(1, min(self.max_width, N))
+        span_pot = semiring.one_(
+            torch.zeros(
+                (semiring.size(), batch, (D - 1) * N + N - D, NT),
+                dtype=terms.dtype,
+                device=terms.device,
+            )
+        )
+
+        # Pruned spans / labels get semiring zero potentials, and pruned
+        # spans are not computed.
+        kept = None
+        if self.keep is not None:
+            keep = self.keep if self.keep.dim() == 4 else self.keep.unsqueeze(-1)
+            # (start, end) of each span cell. Unbuilt cells past the end of
+            # the sentence are kept.
+            n = torch.arange(N, device=keep.device)
+            width = torch.arange(1, D, device=keep.device).repeat_interleave(N)
+            starts = torch.cat([n.repeat(D - 1), n.new_zeros(N - D)])
+            ends = torch.cat([starts[: (D - 1) * N] + width, n[D:]])
+            unbuilt = (ends >= N).unsqueeze(-1)
+            pot_keep = keep[:, starts, ends.clamp(max=N - 1)] | unbuilt
+            semiring.zero_mask_(span_pot, ~pot_keep)
+            kept = _span_index(self.keep, D)
+        span_pot.requires_grad_(force_grad)
+
+        # Charts. Bounded spans of width <= D, and the prefixes [0, j).
+        size = rules[0].shape[-1] if rank else NT
+        beta = [Chart((batch, N, D, size), terms, semiring) for _ in range(2)]
+        top = Chart((batch, 1, N, NT), terms, semiring)
+        prefix = Chart((batch, 1, N, size), terms, semiring)
+
+        def init(terms, roots, span_pot, *ops):
+            ns = torch.arange(N)
+            left, right = self._rank_init(terms, ops, NT)
+            beta[A][ns, 0], beta[B][ns, D - 1] = left, right
+            prefix[:1, 0] = left[:, :, :1]
+
+        def step(w):
+            def step(terms, roots, span_pot, *ops):
+                Y = beta[A][: N - w, :w, :]
+                Z = beta[B][w:, D - w :, :]
+                Y_term, Z_term = terms[:, :, : N - w], terms[:, :, w:]
+                pot = span_pot[:, :, : (D - 1) * N].unflatten(2, (D - 1, N))
+                pot = pot[:, :, w - 1, : N - w]
+                if kept is None:
+                    span, (left, right) = self._step(
+                        w, Y, Z, Y_term, Z_term, ops, NT, pot
+                    )
+                else:
+                    span, (left, right) = self._kept_step(
+                        w, kept[w], Y, Z, Y_term, Z_term, ops, NT, pot
+                    )
+                beta[A][: N - w, w, :] = left
+                beta[B][w:N, D - w - 1, :] = right
+                top[:1, w] = span[:, :, :1]
+                prefix[:1, w] = left[:, :, :1]
+
+            return step
+
+        def spine(j):
+            # Prefix [0, j) from prefix [0, j - D + k) and bounded span
+            # [j - D + k, j) of width D - k.
+            def spine(terms, roots, span_pot, *ops):
+                Y = prefix[:1, j - D - 1 : j - 1]
+                Z = beta[B][j - 1 : j, :]
+                Y_term = terms[:, :, :1] if j == D + 1 else None
+                Z_term = terms[:, :, j - 1 : j]
+                pot = span_pot[:, :, (D - 1) * N + j - D - 1].unsqueeze(2)
+                span, (left, _) = self._step(D, Y, Z, Y_term, Z_term, ops, NT, pot)
+                top[:1, j - 1] = span
+                prefix[:1, j - 1] = left
+
+            return spine
+
+        def final(terms, roots, span_pot, *ops):
+            final = top[0, :]
+            tops = torch.stack(
+                [final[:, i, l - 1] for i, l in enumerate(lengths)], dim=1
+            )
+            return semiring.dot(tops, roots)
+
+        stages = [init] if rank else []
+        stages += [step(w) for w in range(1, D)]
+        stages += [spine(j) for j in range(D + 1, N + 1)] + [final]
+        dp = ChartDP(beta + [top, prefix], stages, self.checkpoint)
+        log_Z = dp(terms, roots, span_pot, *self._rule_ops(rules, NT, T))
+        return semiring.unconvert(log_Z), (terms, rules, roots, span_pot), beta
 
-        # Split into NT/T groups
+    @staticmethod
+    def _rule_params(rules):
+        "The rule tensors carrying potentials."
+        if not isinstance(rules, tuple):
+            return (rules,)
+        return rules[3:] if len(rules) == 4 else rules
+
+    @staticmethod
+    def _with_params(rules, params):
+        "Rules in the same form as `rules`, with potentials `params`."
+        if not isinstance(rules, tuple):
+            return params[0]
+        return rules[:3] + tuple(params) if len(rules) == 4 else tuple(params)
+
+    def _rule_ops(self, rules, NT, T):
+        "Rearrange the rules into the operands used by each width step."
+        if isinstance(rules, tuple) and len(rules) == 4:
+            return self._sparse_ops(rules, NT, T)
+        if isinstance(rules, tuple):
+            # Rank-R factors:
+            # rule(A, B, C) = sum_r parent(A, r) * left(B, r) * right(C, r)
+            parent, left, right = rules
+            return parent.transpose(-2, -1), left, right
+
+        # Flatten the (NT+T) x (NT+T) child block, grouped by child types.
+        ssize, batch, _, S, _ = rules.shape
         NTs = slice(0, NT)
         Ts = slice(NT, S)
-        rules = rules.view(ssize, batch, 1, NT, S, S)
 
         def arr(a, b):
-            return rules[..., a, b].contiguous().view(*v + (NT, -1)).transpose(-2, -1)
+            return rules[..., a, b].reshape(ssize, batch, NT, -1)
 
+        rules = torch.cat(
+            [arr(NTs, NTs), arr(NTs, Ts), arr(Ts, NTs), arr(Ts, Ts)], dim=-1
+        )
+        return (rules.transpose(-2, -1),)
+
+    def _sparse_ops(self, rules, NT, T):
+        """
+        Operands of a rule list: the scores, the parent of each rule, the
+        index of each rule's child pair among the distinct child pairs of
+        the list, and those pairs as (kind, left, right) rows sorted by
+        kind. Kinds 0-3 are the child types (NT, NT), (NT, T), (T, NT),
+        (T, T).
+        """
+        parent, left, right, score = rules
+        S = NT + T
+        kind = 2 * (left >= NT).long() + (right >= NT).long()
+        pairs, rule_pair = torch.unique(
+            (kind * S + left) * S + right, return_inverse=True
+        )
+        pairs = torch.stack((pairs // (S * S), pairs // S % S, pairs % S), -1)
+        return score.unsqueeze(-2), parent, rule_pair, pairs
+
+    def _rank_init(self, term_use, ops, NT):
+        "Project the terminals onto the left / right child factors."
+        _, left, right = ops
+        matmul = self.semiring.matmul
+        return matmul(term_use, left[..., NT:, :]), matmul(term_use, right[..., NT:, :])
+
+    def _kept_step(self, w, index, Y, Z, Y_term, Z_term, ops, NT, pot):
+        """
+        Run :meth:`_step` on the kept spans `index` = (batch, start) only.
+
+        The kept spans of each batch element are packed into as many slots
+        as the most kept spans of any element, so the rules are read per
+        batch element and never copied per span.
+        """
+        b, p = index
+        batch = pot.shape[1]
+        counts = torch.bincount(b, minlength=batch)
+        slot = torch.arange(len(b), device=b.device) - (counts.cumsum(0) - counts)[b]
+        starts = p.new_zeros((batch, int(counts.max()) if len(b) else 0))
+        starts[b, slot] = p
+        rows = torch.arange(batch, device=b.device).unsqueeze(-1)
+
+        def gather(x):
+            return x[:, rows, starts]
+
+        def scatter(x):
+            shape = pot.shape[:3] + x.shape[3:]
+            return _scatter(self.semiring, x[:, b, slot], shape, index)
+
+        span, (left, right) = self._step(
+            w,
+            gather(Y),
+            gather(Z),
+            gather(Y_term),
+            gather(Z_term),
+            ops,
+            NT,
+            gather(pot),
+        )
+        return scatter(span), (scatter(left), scatter(right))
+
+    def _step(self, w, Y, Z, Y_term, Z_term, ops, NT, pot):
+        """
+        Compute the inside scores of spans from the w chart entries of their
+        children, Y (left) and Z (right), times the span potentials `pot`.
+        Y_term and Z_term are the terminals at the outer split points. Y_term
+        is None if the first left child is a nonterminal span.
+
+        Returns the span scores and the values to write into the left
+        and right charts.
+        """
+        semiring = self.semiring
         matmul = semiring.matmul
         times = semiring.times
-        X_Y_Z = arr(NTs, NTs)
-        X_Y1_Z = arr(Ts, NTs)
-        X_Y_Z1 = arr(NTs, Ts)
-        X_Y1_Z1 = arr(Ts, Ts)
+        ssize, batch, n = Z_term.shape[:3]
+
+        if len(ops) == 3:
+            # Each span is projected onto the left / right child factors,
+            # so the split is summed out in the rank space.
+            parent_T, left, right = ops
+            X = semiring.dot(Y.transpose(-2, -1), Z.transpose(-2, -1))
+            span = times(matmul(X, parent_T), pot)
+            return (
+                span,
+                (matmul(span, left[..., :NT, :]), matmul(span, right[..., :NT, :])),
+            )
 
-        for w in range(1, N):
-            all_span = []
-            v2 = v + (N - w, -1)
+        if len(ops) == 4:
+            span = self._sparse_step(w, Y, Z, Y_term, Z_term, ops, NT)
+            span = times(span, pot)
+            return span, (span, span)
+
+        # Scores of all child pairs for each parent span, laid out as the
+        # rule block: (NT, NT), (NT, T), (T, NT), (T, T). Child types that
+        # cannot occur at this width are left out, then the pairs are
+        # contracted with the matching slice of the rules at once.
+        (rules,) = ops
+        T = Z_term.shape[-1]
+        Z_term = Z_term.unsqueeze(-2)
+        first = 0 if Y_term is None else 1
+        X = []
+        if w - 1 > first:
+            inner = matmul(Y[..., first:-1, :].transpose(-2, -1), Z[..., first:-1, :])
+            X.append(inner.flatten(-2))
+        if Y_term is None or w > 1:
+            X.append(times(Y[..., -1, :].unsqueeze(-1), Z_term).flatten(-2))
+        if Y_term is not None:
+            Y_term = Y_term.unsqueeze(-1)
+            right = Z[..., 0, :].unsqueeze(-2) if w > 1 else Z_term
+            X.append(times(Y_term, right).flatten(-2))
+        offsets = (0, NT * NT, NT * NT + NT * T, NT * NT + 2 * NT * T)
+        if w - 1 > first:
+            start = offsets[0]
+        elif Y_term is None or w > 1:
+            start = offsets[1]
+        else:
+            start = offsets[3]
+        end = start + sum((x.shape[-1] for x in X))
+        X = torch.cat(X, dim=-1)
+        span = times(matmul(X, rules[..., start:end, :]), pot)
+        return span, (span, span)
+
+    def _sparse_step(self, w, Y, Z, Y_term, Z_term, ops, NT):
+        """
+        Span scores of :meth:`_step` for a rule list (see :meth:`_sparse_ops`).
+        Only the distinct child pairs of the rules are scored, and each rule
+        is summed into its parent by :meth:`Semiring.scatter_sum`.
+        """
+        semiring = self.semiring
+        times = semiring.times
+        score, parent, rule_pair, pairs = ops
+        first = 0 if Y_term is None else 1
+        counts = torch.bincount(pairs[:, 0], minlength=4).tolist()
+        X = []
+        for kind, kind_pairs in enumerate(pairs.split(counts)):
+            left, right = kind_pairs[:, 1], kind_pairs[:, 2]
+            if kind == 0 and w - 1 > first:
+                Y_in, Z_in = Y[..., first:-1, :NT], Z[..., first:-1, :NT]
+                if 8 * len(kind_pairs) > NT * NT:
+                    # Dense enough for a matmul over all the pairs.
+                    inner = semiring.matmul(Y_in.transpose(-2, -1), Z_in)
+                    X.append(inner[..., left, right])
+                else:
+                    inner = times(Y_in[..., left], Z_in[..., right])
+                    X.append(semiring.sum(inner.transpose(-2, -1)))
+            elif kind == 1 and (Y_term is None or w > 1):
+                X.append(times(Y[..., -1, left], Z_term[..., right - NT]))
+            elif kind == 2 and Y_term is not None and w > 1:
+                X.append(times(Y_term[..., left - NT], Z[..., 0, right]))
+            elif kind == 3 and Y_term is not None and w == 1:
+                X.append(times(Y_term[..., left - NT], Z_term[..., right - NT]))
+            else:
+                # Child pairs that cannot occur at this width.
+                shape = Z_term.shape[:-1] + (len(kind_pairs),)
+                X.append(semiring.zero_(Z_term.new_empty(shape)))
+        X = torch.cat(X, dim=-1)
+        return semiring.scatter_sum(times(X[..., rule_pair], score), parent, NT)
 
-            Y = beta[A][: N - w, :w, :]
-            Z = beta[B][w:, N - w :, :]
-            X1 = matmul(matmul(Y.transpose(-2, -1), Z).view(*v2), X_Y_Z)
-            all_span.append(X1)
+    def decode(self, scores, lengths=None):
+        """
+        Best parse by max-plus CKY with split-point and child backpointers,
+        without autograd.
 
-            Y_term = term_use[..., : N - w, :, None]
-            Z_term = term_use[..., w:, None, :]
+        Parameters:
+            scores : (terms, rules, roots) as in :meth:`marginals`
+            lengths: None or b long tensor mask
 
-            Y = Y[..., -1, :].unsqueeze(-1)
-            X2 = matmul(times(Y, Z_term).view(*v2), X_Y_Z1)
+        Returns:
+            spans : b x (2N-1) x 3 long tensor of the (start, end, label) of
+                    the spans top-down, end inclusive, padded with -1. Terminal
+                    spans are labeled NT + t.
+        """
+        with torch.no_grad():
+            terms, rules, roots = scores
+            batch, N, T = terms.shape
+            NT = roots.shape[-1]
+            S = NT + T
+            rules = self._dense_rules(rules, NT, S).flatten(-2).unsqueeze(1)
+            if lengths is None:
+                lengths = torch.LongTensor([N] * batch)
+            lengths = lengths.to(terms.device)
+            keep = self.keep
+            if keep is not None and keep.dim() == 3:
+                keep = keep.unsqueeze(-1)
+
+            def best(Y, Z):
+                "Best split and child pair of each parent over the splits Y, Z."
+                X, k = (Y.unsqueeze(-1) + Z.unsqueeze(-2)).max(-3)
+                v, pair = (rules + X.flatten(-2).unsqueeze(-2)).max(-1)
+                return v, k.flatten(-2).gather(-1, pair), pair
+
+            # Bounded spans over the NT + T symbols, terminals at width 1.
+            D = N if self.max_width is None else max(1, min(self.max_width, N))
+            beta = [terms.new_full((batch, N, D, S), -float("inf")) for _ in range(2)]
+            beta[A][:, :, 0, NT:] = beta[B][:, :, D - 1, NT:] = terms
+            split = lengths.new_ones((batch, N, D, NT))
+            pair = lengths.new_zeros((batch, N, D, NT))
+            for w in range(1, D):
+                v, k, bc = best(beta[A][:, : N - w, :w], beta[B][:, w:, D - w :])
+                if keep is not None:
+                    pruned = ~keep.diagonal(w, 1, 2).transpose(-2, -1)
+                    v = v.masked_fill(pruned, -float("inf"))
+                beta[A][:, : N - w, w, :NT] = beta[B][:, w:, D - w - 1, :NT] = v
+                split[:, : N - w, w], pair[:, : N - w, w] = k + 1, bc
+
+            # Prefixes [0, j) on the spine.
+            prefix = terms.new_full((batch, N, S), -float("inf"))
+            prefix_split = lengths.new_ones((batch, N, NT))
+            prefix_pair = lengths.new_zeros((batch, N, NT))
+            prefix[:, :D] = beta[A][:, 0]
+            prefix_split[:, :D], prefix_pair[:, :D] = split[:, 0], pair[:, 0]
+            for j in range(D + 1, N + 1):
+                Y = prefix[:, None, j - D - 1 : j - 1]
+                v, k, bc = best(Y, beta[B][:, j - 1 : j])
+                if keep is not None:
+                    v = v.masked_fill(~keep[:, None, 0, j - 1], -float("inf"))
+                prefix[:, j - 1, :NT] = v[:, 0]
+                prefix_split[:, j - 1], prefix_pair[:, j - 1] = (
+                    j - D + k[:, 0],
+                    bc[:, 0],
+                )
+
+            def children(b, s, w, l):
+                spine = w > D
+                d = (w - 1).clamp(max=D - 1)
+                left = torch.where(spine, prefix_split[b, w - 1, l], split[b, s, d, l])
+                bc = torch.where(spine, prefix_pair[b, w - 1, l], pair[b, s, d, l])
+                return left, torch.div(bc, S, rounding_mode="floor"), bc % S
+
+            b = torch.arange(batch, device=terms.device)
+            root = (prefix[b, lengths - 1, :NT] + roots).argmax(-1)
+            return _traceback(N, (b, lengths, root), children)
+
+    def _dense_rules(self, rules, NT, S):
+        "Rules as a dense b x NT x S x S log-potential tensor."
+        if not isinstance(rules, tuple):
+            return rules
+        if len(rules) == 3:
+            return self.rank_rules(*rules)
+        parent, left, right, score = rules
+        dense = score.new_full((score.shape[0], NT, S, S), -float("inf"))
+        dense[:, parent, left, right] = score
+        return dense
+
+    def prefixes(self, scores, lengths=None):
+        """
+        Compute the log probability of each sentence prefix by incremental
+        CKY (see :meth:`prefix_iter`).
 
-            Z = Z[..., 0, :].unsqueeze(-2)
-            X3 = matmul(times(Y_term, Z).view(*v2), X_Y1_Z)
-            all_span += [X2, X3]
+        Parameters:
+            scores : (terms, rules, roots) as in :meth:`marginals`
+            lengths: None or b long tensor mask
 
-            if w == 1:
-                X4 = matmul(times(Y_term, Z_term).view(*v2), X_Y1_Z1)
-                all_span.append(X4)
+        Returns:
+            prefix : b x N log probabilities of the prefixes [0, j), 0 past
+                     each length
+        """
+        terms, rules, roots = scores
+        prefix = torch.stack(list(self.prefix_iter(rules, roots, terms.unbind(1))), 1)
+        if lengths is not None:
+            N = terms.shape[1]
+            mask = torch.arange(N, device=prefix.device) >= lengths.to(
+                prefix.device
+            ).view(-1, 1)
+            prefix = prefix.masked_fill(mask, 0)
+        return prefix
+
+    @torch.no_grad()
+    def prefix_iter(self, rules, roots, terms):
+        """
+        Incremental inside pass for left-to-right scoring, after Jelinek and
+        Lafferty. Each token extends the chart by the spans ending at it,
+        reusing all previous cells, and yields the probability that a
+        sentence starts with the tokens so far. Runs without autograd.
 
-            span[w] = semiring.sum(torch.stack(all_span, dim=-1))
-            beta[A][: N - w, w, :] = span[w]
-            beta[B][w:N, N - w - 1, :] = span[w]
+        The potentials must be the log-probabilities of a proper and
+        consistent PCFG: the rules of each nonterminal and the terminal
+        scores of each preterminal over the vocabulary sum to one.
 
-        final = beta[A][0, :, NTs]
-        top = torch.stack([final[:, i, l - 1] for i, l in enumerate(lengths)], dim=1)
-        log_Z = semiring.dot(top, roots)
-        return semiring.unconvert(log_Z), (term_use, rules, top, span[1:]), beta
+        Parameters:
+            rules : rules as in :meth:`marginals`
+            roots : b x NT
+            terms : iterable of b x T terminal scores, one per token
 
-    def marginals(self, scores, lengths=None, _autograd=True):
+        Yields:
+            prefix : b log probability of the prefix read so far
+        """
+        assert self.semiring is LogSemiring, "Prefix probabilities are in log space"
+        terms = iter(terms)
+        term = next(terms, None)
+        if term is None:
+            return
+        batch, NT = roots.shape
+        T = term.shape[-1]
+        S = NT + T
+        rules = self._dense_rules(rules, NT, S)
+
+        # Left-corner closure R = (I - P)^-1 of P(A, B) = sum_C p(A -> B C),
+        # folded into the rules: the parent of a prefix span is reached
+        # from the rule's parent by a chain of left children.
+        corner = torch.logsumexp(rules[:, :, :NT], -1).exp()
+        eye = torch.eye(NT, dtype=rules.dtype, device=rules.device)
+        closure = torch.linalg.inv(eye - corner).clamp(min=0).log()
+        rules_lc = torch.logsumexp(closure[..., None, None] + rules[:, None], 2)
+        # A preterminal left corner covering the last token, right child free.
+        term_lc = torch.logsumexp(rules_lc[:, :, NT:], -1)
+
+        # Inside and prefix charts (start, end), grown by doubling.
+        size = 0
+        inside = prefix = rules.new_empty((batch, 0, 0, S))
+
+        def grow(chart, n):
+            new = chart.new_full((batch, n, n, S), -float("inf"))
+            new[:, : chart.shape[1], : chart.shape[1]] = chart
+            return new
+
+        def combine(rules, Y, Z):
+            "Sum over the splits and child pairs of spans Y, Z."
+            X = torch.logsumexp(Y.unsqueeze(-1) + Z.unsqueeze(-2), 1)
+            return torch.logsumexp((rules + X.unsqueeze(1)).flatten(-2), -1)
+
+        j = 0
+        while term is not None:
+            if j == size:
+                size = max(1, 2 * size)
+                inside, prefix = grow(inside, size), grow(prefix, size)
+            inside[:, j, j, NT:] = prefix[:, j, j, NT:] = term
+            prefix[:, j, j, :NT] = torch.logsumexp(term_lc + term[:, None], -1)
+            for i in range(j - 1, -1, -1):
+                Y = inside[:, i, i:j]
+                inside[:, i, j, :NT] = combine(rules, Y, inside[:, i + 1 : j + 1, j])
+                prefix[:, i, j, :NT] = combine(rules_lc, Y, prefix[:, i + 1 : j + 1, j])
+            yield torch.logsumexp(roots + prefix[:, 0, j, :NT], -1)
+            term = next(terms, None)
+            j += 1
+
+    def marginals(self, scores, lengths=None, _autograd=False):
         """
         Compute the marginals of a CFG using CKY.
 
         Parameters:
             terms : b x n x T
-            rules : b x NT x (NT+T) x (NT+T)
+            rules : b x NT x (NT+T) x (NT+T) or
+                    (b x NT x R, b x (NT+T) x R, b x (NT+T) x R) rank-R factors or
+                    (parent, left, right, score) rule list of n long indices
+                    and b x n scores
             root:   b x NT
 
         Returns:
             v: b tensor of total sum
             spans: bxNxT terms, (bxNTx(NT+S)x(NT+S)) rules, bxNT roots
 
+            Rule marginals are returned in factored form (parent, left, right)
+            when the rules are given as factors, and as a rule list with
+            b x n marginals when the rules are given as a list.
+
+        Marginals are the gradients of the inside pass, taken by the
+        backward of :class:`ChartDP`: it recomputes each width stage from
+        the stored inside chart and calls `torch.autograd.grad` on it, from
+        the widest span down, so only one stage of graph is alive at a time.
+        It runs for any semiring, e.g. Log and Max. Gradients of the
+        marginals are available on request by recomputing the inside pass
+        with a graph (`_autograd=True` keeps that graph from the start).
         """
         terms, rules, roots = scores
+        if _autograd:
+            marg = self._marginals(scores, lengths, create_graph=True)
+        else:
+
+            def pack(ps):
+                return (ps[0], self._with_params(rules, ps[2:]), ps[1])
+
+            marg = _Marginals.apply(
+                self, lengths, pack, terms, roots, *self._rule_params(rules)
+            )
+        term_marg, root_marg, spans_marg = marg[:3]
+        rule_marg = self._with_params(rules, marg[3:])
+        return (term_marg, rule_marg, root_marg, spans_marg)
+
+    def _marginals(self, scores, lengths=None, create_graph=False):
+        "Marginals as a flat tuple (terms, roots, spans, *rules)."
+        terms, rules, roots = scores
         batch, N, T = terms.shape
-        _, NT, _, _ = rules.shape
-        v, (term_use, rule_use, top, spans), alpha = self._dp(
+        NT = roots.shape[-1]
+        semiring = self.semiring
+        v, (term_use, rule_use, root_use, span_pot), _ = self._dp(
             scores, lengths=lengths, force_grad=True
         )
-
+        params = self._rule_params(rule_use)
         marg = torch.autograd.grad(
             v.sum(dim=0),
-            (rule_use, top, term_use) + tuple(spans),
-            create_graph=True,
+            params + (root_use, term_use, span_pot),
+            create_graph=create_graph,
             only_inputs=True,
             allow_unused=False,
         )
-
-        spans_marg = torch.zeros(
-            batch, N, N, NT, dtype=scores[1].dtype, device=scores[1].device
-        )
-        span_ls = marg[3:]
-        for w in range(len(span_ls)):
-            spans_marg[:, w, : N - w - 1] = self.semiring.unconvert(
-                span_ls[w].squeeze(1)
-            )
-        rule_use = self.semiring.unconvert(marg[0]).squeeze(1)
-        term_marg = self.semiring.unconvert(marg[2])
-        root_marg = self.semiring.unconvert(marg[1])
+        n = len(params)
+        rule_marg = tuple((semiring.unconvert(m) for m in marg[:n]))
+        root_marg, term_marg, spans_marg = (semiring.unconvert(m) for m in marg[n:])
+        spans_marg = self._full_spans(spans_marg, N)
 
         assert term_marg.shape == (batch, N, T)
         assert root_marg.shape == (batch, NT)
-        assert rule_use.shape == (batch, NT, NT + T, NT + T)
-        return (term_marg, rule_use, root_marg, spans_marg)
+        if not isinstance(rule_use, tuple):
+            assert rule_marg[0].shape == (batch, NT, NT + T, NT + T)
+        return (term_marg, root_marg, spans_marg) + rule_marg
+
+    def _full_spans(self, spans, N):
+        """
+        Spread the b x C x NT span cells of :meth:`_dp` into the
+        b x N x N x NT (width - 1, start) layout, with 0 for the spans
+        that are not built.
+        """
+        batch, _, NT = spans.shape
+        D = N if self.max_width is None else max(1, min(self.max_width, N))
+        full = spans.new_zeros((batch, N, N, NT))
+        full[:, : D - 1] = spans[:, : (D - 1) * N].view(batch, D - 1, N, NT)
+        full[:, D - 1 : N - 1, 0] = spans[:, (D - 1) * N :]
+        return full
+
+    @staticmethod
+    def rank_rules(parent, left, right):
+        """
+        Expand rank-R rule factors into a dense log-potential rule tensor.
+
+        Parameters:
+            parent : b x NT x R
+            left : b x (NT+T) x R
+            right : b x (NT+T) x R
+
+        Returns:
+            rules : b x NT x (NT+T) x (NT+T)
+        """
+        return torch.logsumexp(
+            parent[:, :, None, None] + left[:, None, :, None] + right[:, None, None, :],
+            dim=-1,
+        )
 
     def score(self, potentials, parts):
         terms, rules, roots = potentials[:3]
         m_term, m_rule, m_root = parts[:3]
+        if isinstance(rules, tuple) and len(rules) == 4:
+            rules, m_rule = rules[3], m_rule[3]
+        elif isinstance(rules, tuple):
+            rules = self.rank_rules(*rules)
         b = m_term.shape[0]
         return (
             m_term.mul(terms).view(b, -1).sum(-1)
@@ -289,3 +791,70 @@ class CKY(_Struct):
         rules = torch.rand(batch, NT, (NT + T), (NT + T))
         roots = torch.rand(batch, NT)
         return (terms, rules, roots), (batch.item(), N.item())
+
+
+class ExpectedCounts:
+    """
+    Accumulate the expected rule, term and root counts of a PCFG over
+    batches of sentences, for EM.
+
+    The grammar is shared by all sentences, so the inside pass broadcasts a
+    single copy of the rules over the batch and one first-order backward (the
+    outside sweep of :class:`ChartDP`) sums the counts of the whole batch
+    into grammar-shaped tensors. No per-sentence *b x NT x S x S* rule
+    marginals and no second-order graph are kept.
+
+    Parameters:
+        emit : T x V log-probabilities of the words of each preterminal
+        rules : NT x (NT+T) x (NT+T) log-probabilities
+        roots : NT log-probabilities
+        struct : CKY running the inside pass (default: CKY())
+    """
+
+    def __init__(self, emit, rules, roots, struct=None):
+        self.grammar = tuple((g.detach() for g in (emit, rules, roots)))
+        self.struct = CKY() if struct is None else struct
+        self.reset()
+
+    def reset(self):
+        "Clear the counts and the log-likelihood."
+        self.counts = tuple((torch.zeros_like(g) for g in self.grammar))
+        self.log_likelihood = self.grammar[2].new_zeros(())
+
+    def add(self, words, lengths=None):
+        """
+        Add the expected counts of a batch.
+
+        Parameters:
+            words : b x N long tensor of word ids
+            lengths: None or b long tensor mask
+
+        Returns:
+            log_Z : b log-likelihoods of the sentences
+        """
+        with torch.enable_grad():
+            emit, rules, roots = (g.clone().requires_grad_(True) for g in self.grammar)
+            terms = emit[:, words].permute(1, 2, 0)
+            log_Z = self.struct.sum((terms, rules[None], roots[None]), lengths)
+            counts = torch.autograd.grad(log_Z.sum(), (emit, rules, roots))
+        self.counts = tuple((c + n for c, n in zip(self.counts, counts)))
+        self.log_likelihood = self.log_likelihood + log_Z.detach().sum()
+        return log_Z.detach()
+
+    def update(self, smooth=0.0):
+        """
+        M-step: normalize the counts into a new grammar.
+
+        Parameters:
+            smooth : pseudo-count added to every count
+
+        Returns:
+            (emit, rules, roots) log-probabilities
+        """
+        emit, rules, roots = (c + smooth for c in self.counts)
+        NT = roots.shape[0]
+        return (
+            emit.log() - emit.sum(-1, keepdim=True).log(),
+            rules.log() - rules.view(NT, -1).sum(-1).log()[:, None, None],
+            roots.log() - roots.sum().log(),
+        )
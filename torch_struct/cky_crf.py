@@ -1,5 +1,6 @@
 import torch
-from .helpers import _Struct, Chart
+from .helpers import _Struct, Chart, ChartDP, _span_index, _scatter, _traceback
+from .semirings import LogSemiring
 
 A, B = 0, 1
 
@@ -32,6 +33,54 @@ A, B = 0, 1
 
 
 class CKY_CRF(_Struct):
+    """
+    Inside algorithm for a 0th-order span CRF.
+
+    Parameters:
+        semiring : semiring of the DP
+        checkpoint : widths recomputed together in backward (see :class:`ChartDP`)
+        max_width : if given, only spans of width at most `max_width` are built
+                    by CKY. Longer spans are restricted to the prefixes [0, j),
+                    a left-branching spine of bounded spans closing the tree.
+                    The charts then keep O(N max_width) cells.
+        keep : optional *b x N x N* bool mask of the spans (start, end) to
+               build, or *b x N x N x NT* mask of their labels, e.g. from
+               :meth:`prune`. Width steps only compute the kept spans.
+    """
+
+    _chart_marginals = True
+
+    def __init__(self, semiring=LogSemiring, checkpoint=1, max_width=None, keep=None):
+        super().__init__(semiring, checkpoint)
+        self.max_width = max_width
+        self.keep = keep
+
+    @staticmethod
+    def prune(marginals, threshold=None, beam=None):
+        """
+        Span mask for coarse-to-fine parsing from first-pass marginals.
+
+        Parameters:
+            marginals : b x N x N x NT span label marginals (or scores)
+            threshold : keep the labels with marginals of at least `threshold`
+            beam : keep at most the `beam` best labels of each span
+
+        Returns:
+            keep : b x N x N x NT bool mask. Labels of width-1 spans are
+                   always kept.
+        """
+        keep = torch.ones_like(marginals, dtype=torch.bool)
+        if threshold is not None:
+            keep = marginals >= threshold
+        if beam is not None:
+            k = min(beam, marginals.shape[-1])
+            best = torch.zeros_like(keep)
+            best.scatter_(-1, marginals.topk(k, dim=-1)[1], True)
+            keep = keep & best
+        N = marginals.shape[1]
+        keep[:, torch.arange(N), torch.arange(N)] = True
+        return keep
+
     def _check_potentials(self, edge, lengths=None):
         batch, N, _, NT = edge.shape
         edge.requires_grad_(True)
@@ -45,31 +94,123 @@ class CKY_CRF(_Struct):
         semiring = self.semiring
         scores, batch, N, NT, lengths = self._check_potentials(scores, lengths)
 
-        beta = [Chart((batch, N, N), scores, semiring) for _ in range(2)]
+        # Bounded spans of width <= D, and the prefixes [0, j).
+        D = N if self.max_width is None else max(1, min(self.max_width, N))
+        beta = [Chart((batch, N, D), scores, semiring) for _ in range(2)]
+        top = Chart((batch, 1, N), scores, semiring)
         L_DIM, R_DIM = 2, 3
 
-        # Initialize
-        reduced_scores = semiring.sum(scores)
-        term = reduced_scores.diagonal(0, L_DIM, R_DIM)
-        ns = torch.arange(N)
-        beta[A][ns, 0] = term
-        beta[B][ns, N - 1] = term
+        # Pruned labels are semiring zero, pruned spans are not computed.
+        pruned, kept = scores, None
+        if self.keep is not None:
+            keep = self.keep if self.keep.dim() == 4 else self.keep.unsqueeze(-1)
+            pruned = scores.clone()
+            semiring.zero_mask_(pruned, ~keep)
+            kept = _span_index(self.keep, D)
+
+        def init(reduced_scores):
+            term = reduced_scores.diagonal(0, L_DIM, R_DIM)
+            ns = torch.arange(N)
+            beta[A][ns, 0] = term
+            beta[B][ns, D - 1] = term
+            top[:1, 0] = term[:, :, :1]
+
+        def step(w):
+            def step(reduced_scores):
+                left = slice(None, N - w)
+                right = slice(w, None)
+                Y = beta[A][left, :w]
+                Z = beta[B][right, D - w :]
+                score = reduced_scores.diagonal(w, L_DIM, R_DIM)
+                if kept is None:
+                    new = semiring.times(semiring.dot(Y, Z), score)
+                else:
+                    b, p = kept[w]
+                    new = semiring.dot(Y[:, b, p], Z[:, b, p])
+                    new = semiring.times(new, score[:, b, p])
+                    new = _scatter(semiring, new, score.shape, (b, p))
+                beta[A][left, w] = new
+                beta[B][right, D - w - 1] = new
+                top[:1, w] = new[:, :, :1]
+
+            return step
+
+        def spine(j):
+            # Prefix [0, j) from prefix [0, j - D + k) and bounded span
+            # [j - D + k, j) of width D - k.
+            def spine(reduced_scores):
+                Y = top[0, j - D - 1 : j - 1]
+                Z = beta[B][j - 1, :]
+                score = reduced_scores[:, :, 0, j - 1]
+                top[0, j - 1] = semiring.times(semiring.dot(Y, Z), score)
+
+            return spine
+
+        def final(reduced_scores):
+            final = top[0, :]
+            return final[:, torch.arange(batch), lengths - 1]
 
         # Run
-        for w in range(1, N):
-            left = slice(None, N - w)
-            right = slice(w, None)
-            Y = beta[A][left, :w]
-            Z = beta[B][right, N - w :]
-            score = reduced_scores.diagonal(w, L_DIM, R_DIM)
-            new = semiring.times(semiring.dot(Y, Z), score)
-            beta[A][left, w] = new
-            beta[B][right, N - w - 1] = new
-
-        final = beta[A][0, :]
-        log_Z = final[:, torch.arange(batch), lengths - 1]
+        stages = [init] + [step(w) for w in range(1, D)]
+        stages += [spine(j) for j in range(D + 1, N + 1)] + [final]
+        dp = ChartDP(beta + [top], stages, self.checkpoint)
+        log_Z = dp(semiring.sum(pruned))
         return log_Z, [scores], beta
 
+    def decode(self, scores, lengths=None):
+        """
+        Best tree by max-plus CKY with split-point and label backpointers,
+        without autograd.
+
+        Parameters:
+            scores : b x N x N x NT span scores
+            lengths: None or b long tensor mask
+
+        Returns:
+            spans : b x (2N-1) x 3 long tensor of the (start, end, label) of
+                    the spans top-down, end inclusive, padded with -1
+        """
+        with torch.no_grad():
+            batch, N, _, NT = scores.shape
+            if lengths is None:
+                lengths = torch.LongTensor([N] * batch)
+            lengths = lengths.to(scores.device)
+            if self.keep is not None:
+                keep = self.keep if self.keep.dim() == 4 else self.keep.unsqueeze(-1)
+                scores = scores.masked_fill(~keep, -float("inf"))
+            label_score, label = scores.max(-1)
+
+            # Bounded spans (start, width) and (end, D - width), as in `_dp`.
+            D = N if self.max_width is None else max(1, min(self.max_width, N))
+            ns = torch.arange(N)
+            beta = [scores.new_full((batch, N, D), -float("inf")) for _ in range(2)]
+            beta[A][:, :, 0] = beta[B][:, :, D - 1] = label_score[:, ns, ns]
+            split = lengths.new_ones((batch, N, D))
+            for w in range(1, D):
+                best, k = (beta[A][:, : N - w, :w] + beta[B][:, w:, D - w :]).max(-1)
+                new = best + label_score.diagonal(w, 1, 2)
+                beta[A][:, : N - w, w] = beta[B][:, w:, D - w - 1] = new
+                split[:, : N - w, w] = k + 1
+
+            # Prefixes [0, j) on the spine.
+            prefix = scores.new_full((batch, N), -float("inf"))
+            prefix_split = lengths.new_ones((batch, N))
+            prefix[:, :D], prefix_split[:, :D] = beta[A][:, 0], split[:, 0]
+            for j in range(D + 1, N + 1):
+                best, k = (prefix[:, j - D - 1 : j - 1] + beta[B][:, j - 1]).max(-1)
+                prefix[:, j - 1] = best + label_score[:, 0, j - 1]
+                prefix_split[:, j - 1] = j - D + k
+
+            def children(b, s, w, _):
+                left = torch.where(
+                    w > D, prefix_split[b, w - 1], split[b, s, (w - 1).clamp(max=D - 1)]
+                )
+                return left, label[b, s, s + left - 1], label[b, s + left, s + w - 1]
+
+            b = torch.arange(batch, device=scores.device)
+            roots = b, lengths, label[b, 0, lengths - 1]
+            return _traceback(N, roots, children)
+
     # For testing
 
     def enumerate(self, scores):
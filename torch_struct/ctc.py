@@ -0,0 +1,195 @@
+r"""
+
+Connectionist temporal classification (CTC).
+
+Considers alignments of T frames to a target sequence :math:`y_{1:L}`.
+Frames are labeled with the states of the blank-interleaved target
+:math:`\epsilon, y_1, \epsilon, \ldots, y_L, \epsilon`, in order, skipping a
+blank only between two different labels.
+
+Function factors as :math:`f(z) = \prod_{t=1}^T \phi(t, z_t)`
+
+Example use cases:
+
+* Speech recognition
+* Handwriting and OCR recognition
+
+"""
+
+import torch
+from .helpers import _Struct, Chart, ChartDP
+from .semirings import LogSemiring
+
+
+class CTC(_Struct):
+    """
+    Blank-interleaved CTC forward pass over the frames.
+
+    Parameters:
+        semiring : semiring of the DP
+        targets : b x L long tensor of target labels
+        target_lengths : None or b long tensor of target lengths
+        blank : blank label
+        checkpoint : frames recomputed together in backward (see :class:`ChartDP`)
+    """
+
+    def __init__(
+        self,
+        semiring=LogSemiring,
+        targets=None,
+        target_lengths=None,
+        blank=0,
+        checkpoint=1,
+    ):
+        super().__init__(semiring, checkpoint)
+        self.targets = targets
+        self.target_lengths = target_lengths
+        self.blank = blank
+
+    def _check_potentials(self, edge, lengths=None):
+        batch, T, V = edge.shape
+        assert self.targets is not None, "CTC needs targets"
+        edge.requires_grad_(True)
+        edge = self.semiring.convert(edge)
+        if lengths is None:
+            lengths = torch.LongTensor([T] * batch)
+        else:
+            assert max(lengths) <= T, "Length longer than edge scores"
+        lengths = lengths.to(edge.device)
+
+        targets = self.targets.to(edge.device)
+        target_lengths = self.target_lengths
+        if target_lengths is None:
+            target_lengths = torch.LongTensor([targets.shape[1]] * batch)
+        target_lengths = target_lengths.to(edge.device)
+        return edge, batch, T, V, lengths, targets, target_lengths
+
+    def _extend(self, targets):
+        "States of the blank-interleaved targets, and the states that may skip a blank."
+        batch, L = targets.shape
+        states = targets.new_full((batch, 2 * L + 1), self.blank)
+        states[:, 1::2] = targets
+        skip = torch.zeros_like(states, dtype=torch.bool)
+        skip[:, 2:] = (states[:, 2:] != self.blank) & (states[:, 2:] != states[:, :-2])
+        return states, skip
+
+    def _dp(self, log_potentials, lengths=None, force_grad=False):
+        semiring = self.semiring
+        ssize = semiring.size()
+        edge, batch, T, V, lengths, targets, target_lengths = self._check_potentials(
+            log_potentials, lengths
+        )
+        states, skip = self._extend(targets)
+        S = states.shape[1]
+        emit = edge.gather(3, states[None, :, None, :].expand(ssize, batch, T, S))
+
+        # alpha[s, t] sums the paths of frames [0, t] ending in state s.
+        alpha = Chart((batch, S, T), edge, semiring)
+
+        def shift(x, k):
+            pad = semiring.zero_(x[..., :k].clone())
+            return torch.cat([pad, x[..., : max(S - k, 0)]], dim=-1)
+
+        def init(emit):
+            first = emit[:, :, 0].clone()
+            semiring.zero_mask_(first, torch.arange(S, device=first.device) >= 2)
+            alpha[:, 0] = first
+
+        def step(t):
+            def step(emit):
+                prev = alpha[:, t - 1]
+                jump = shift(prev, 2)
+                semiring.zero_mask_(jump, ~skip)
+                st = torch.stack([prev, shift(prev, 1), jump], dim=-1)
+                alpha[:, t] = semiring.times(semiring.sum(st), emit[:, :, t])
+
+            return step
+
+        def final(emit):
+            last = alpha[:, :].gather(
+                3, (lengths - 1)[None, :, None, None].expand(ssize, batch, S, 1)
+            )[..., 0]
+            ends = torch.stack([2 * target_lengths, 2 * target_lengths - 1], dim=-1)
+            v = last.gather(2, ends.clamp(min=0)[None].expand(ssize, batch, 2))
+            semiring.zero_mask_(v, ends < 0)
+            return semiring.sum(v)
+
+        stages = [init] + [step(t) for t in range(1, T)] + [final]
+        v = ChartDP([alpha], stages, self.checkpoint)(emit)
+        return v, [edge], None
+
+    @staticmethod
+    def to_parts(sequence, extra, lengths=None):
+        """
+        Convert a sequence representation to frame labels
+
+        Parameters:
+            sequence : b x T long tensor in [0, V-1]
+            V : number of labels
+            lengths: b long tensor of T values
+        Returns:
+            parts : b x T x V frame label indicators
+        """
+        V = extra
+        batch, T = sequence.shape
+        parts = torch.zeros(batch, T, V).long()
+        parts.scatter_(2, sequence.unsqueeze(-1), 1)
+        if lengths is not None:
+            for b in range(batch):
+                parts[b, lengths[b] :] = 0
+        return parts
+
+    @staticmethod
+    def from_parts(parts):
+        """
+        Convert frame labels to sequence representation.
+
+        Parameters:
+            parts : b x T x V frame label indicators
+        Returns:
+            sequence : b x T long tensor in [0, V-1]
+        """
+        return parts.argmax(-1), parts.shape[-1]
+
+    # For testing
+
+    def enumerate(self, edge, lengths=None):
+        semiring = self.semiring
+        edge, batch, T, V, lengths, targets, target_lengths = self._check_potentials(
+            edge, lengths
+        )
+        states, skip = self._extend(targets)
+
+        paths = []
+        for b in range(batch):
+            S = 2 * target_lengths[b].item() + 1
+            seqs = [[s] for s in range(min(2, S))]
+            for t in range(1, lengths[b]):
+                seqs = [
+                    q + [s]
+                    for q in seqs
+                    for s in range(q[-1], min(q[-1] + 3, S))
+                    if s - q[-1] < 2 or skip[b, s]
+                ]
+            paths.append([states[b, q].tolist() for q in seqs if q[-1] >= S - 2])
+
+        enum_lengths = torch.LongTensor([len(p) for p in paths])
+        edges = torch.zeros(enum_lengths.max().item(), batch, T, V)
+        ret = []
+        for b, labels in enumerate(paths):
+            scores = []
+            for k, label in enumerate(labels):
+                frames = torch.arange(len(label))
+                edges[k, b, frames, label] = 1
+                scores.append(semiring.prod(edge[:, b, frames, label]))
+            ret.append(semiring.sum(torch.stack(scores, dim=-1)))
+        ret = torch.stack(ret, dim=1)
+        return semiring.unconvert(ret), None, edges, enum_lengths
+
+    @staticmethod
+    def _rand():
+        batch = torch.randint(2, 4, (1,))
+        T = torch.randint(4, 7, (1,))
+        V = torch.randint(2, 4, (1,))
+        log_probs = torch.rand(batch, T, V).log_softmax(-1)
+        return log_probs, (batch.item(), T.item())
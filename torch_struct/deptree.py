@@ -1,6 +1,6 @@
 import torch
 import itertools
-from .helpers import _Struct, Chart
+from .helpers import _Struct, Chart, ChartDP
 
 
 def _convert(logits):
@@ -46,6 +46,8 @@ class DepTree(_Struct):
     arc_scores : b x N x N arc scores with root scores on diagonal.
     """
 
+    _chart_marginals = True
+
     def _dp(self, arc_scores_in, lengths=None, force_grad=False):
         semiring = self.semiring
         arc_scores = _convert(arc_scores_in)
@@ -58,42 +60,58 @@ class DepTree(_Struct):
             ]
             for _ in range(2)
         ]
-        semiring.one_(alpha[A][C][L].data[:, :, :, 0].data)
-        semiring.one_(alpha[A][C][R].data[:, :, :, 0].data)
-        semiring.one_(alpha[B][C][L].data[:, :, :, -1].data)
-        semiring.one_(alpha[B][C][R].data[:, :, :, -1].data)
 
-        for k in range(1, N):
-            f = torch.arange(N - k), torch.arange(k, N)
-            ACL = alpha[A][C][L][: N - k, :k]
-            ACR = alpha[A][C][R][: N - k, :k]
+        def init(arc_scores):
+            one = semiring.one_(torch.zeros_like(arc_scores[:, :, :, 0]))
+            alpha[A][C][L][:, 0] = one
+            alpha[A][C][R][:, 0] = one
+            alpha[B][C][L][:, N - 1] = one
+            alpha[B][C][R][:, N - 1] = one
+
+        def incomplete(k):
+            def incomplete(arc_scores):
+                f = torch.arange(N - k), torch.arange(k, N)
+                ACR = alpha[A][C][R][: N - k, :k]
+                BCL = alpha[B][C][L][k:, N - k :]
+                x = semiring.dot(ACR, BCL)
+
+                arcs_l = semiring.times(x, arc_scores[:, :, f[1], f[0]])
+                alpha[A][I][L][: N - k, k] = arcs_l
+                alpha[B][I][L][k:N, N - k - 1] = arcs_l
 
-            BCL = alpha[B][C][L][k:, N - k :]
-            BCR = alpha[B][C][R][k:, N - k :]
-            x = semiring.dot(ACR, BCL)
+                arcs_r = semiring.times(x, arc_scores[:, :, f[0], f[1]])
+                alpha[A][I][R][: N - k, k] = arcs_r
+                alpha[B][I][R][k:N, N - k - 1] = arcs_r
 
-            arcs_l = semiring.times(x, arc_scores[:, :, f[1], f[0]])
+            return incomplete
 
-            alpha[A][I][L][: N - k, k] = arcs_l
-            alpha[B][I][L][k:N, N - k - 1] = arcs_l
+        def complete(k):
+            def complete(arc_scores):
+                ACL = alpha[A][C][L][: N - k, :k]
+                BCR = alpha[B][C][R][k:, N - k :]
+                AIR = alpha[A][I][R][: N - k, 1 : k + 1]
+                BIL = alpha[B][I][L][k:, N - k - 1 : N - 1]
 
-            arcs_r = semiring.times(x, arc_scores[:, :, f[0], f[1]])
-            alpha[A][I][R][: N - k, k] = arcs_r
-            alpha[B][I][R][k:N, N - k - 1] = arcs_r
+                new = semiring.dot(ACL, BIL)
+                alpha[A][C][L][: N - k, k] = new
+                alpha[B][C][L][k:N, N - k - 1] = new
 
-            AIR = alpha[A][I][R][: N - k, 1 : k + 1]
-            BIL = alpha[B][I][L][k:, N - k - 1 : N - 1]
+                new = semiring.dot(AIR, BCR)
+                alpha[A][C][R][: N - k, k] = new
+                alpha[B][C][R][k:N, N - k - 1] = new
 
-            new = semiring.dot(ACL, BIL)
-            alpha[A][C][L][: N - k, k] = new
-            alpha[B][C][L][k:N, N - k - 1] = new
+            return complete
 
-            new = semiring.dot(AIR, BCR)
-            alpha[A][C][R][: N - k, k] = new
-            alpha[B][C][R][k:N, N - k - 1] = new
+        def final(arc_scores):
+            final = alpha[A][C][R][(0,)]
+            return torch.stack([final[:, i, l] for i, l in enumerate(lengths)], dim=1)
 
-        final = alpha[A][C][R][(0,)]
-        v = torch.stack([final[:, i, l] for i, l in enumerate(lengths)], dim=1)
+        stages = [init]
+        for k in range(1, N):
+            stages += [incomplete(k), complete(k)]
+        charts = [c for a in alpha for b in a for c in b]
+        dp = ChartDP(charts, stages + [final], 2 * self.checkpoint)
+        v = dp(arc_scores)
         return v, [arc_scores], alpha
 
     def _check_potentials(self, arc_scores, lengths=None):
@@ -111,7 +129,105 @@ class DepTree(_Struct):
         return arc_scores, batch, N, lengths
 
     def _arrange_marginals(self, grads):
-        return self.semiring.convert(_unconvert(self.semiring.unconvert(grads[0])))
+        g = grads[0]
+        return _unconvert(g.flatten(0, 1)).view(g.shape[:2] + (g.shape[2] - 1,) * 2)
+
+    def decode(self, arc_scores, lengths=None):
+        """
+        Best projective tree by max-plus Eisner with split-point
+        backpointers, without autograd.
+
+        Parameters:
+            arc_scores : b x N x N arc scores with root scores on diagonal.
+            lengths: None or b long tensor mask
+
+        Returns:
+            sequence : b x N long tensor of heads in [0, N] (indexing is +1)
+        """
+        with torch.no_grad():
+            arc_scores = _convert(arc_scores)
+            batch, N, _ = arc_scores.shape
+            if lengths is None:
+                lengths = torch.LongTensor([N - 1] * batch)
+            lengths = lengths.to(arc_scores.device)
+            out = torch.arange(N, device=arc_scores.device) > lengths[:, None]
+            arc_scores = arc_scores.masked_fill(
+                out[:, :, None] | out[:, None, :], -float("inf")
+            )
+
+            # Charts (start, width) and (end, N - 1 - width), as in `_dp`.
+            alpha = [
+                [
+                    [
+                        arc_scores.new_full((batch, N, N), -float("inf"))
+                        for _ in range(2)
+                    ]
+                    for _ in range(2)
+                ]
+                for _ in range(2)
+            ]
+            for d in [L, R]:
+                alpha[A][C][d][:, :, 0] = alpha[B][C][d][:, :, N - 1] = 0
+            split = lengths.new_zeros((2, 2, batch, N, N))
+
+            for k in range(1, N):
+                f = torch.arange(N - k), torch.arange(k, N)
+                ACR = alpha[A][C][R][:, : N - k, :k]
+                BCL = alpha[B][C][L][:, k:, N - k :]
+                x, r = (ACR + BCL).max(-1)
+
+                arcs_l = x + arc_scores[:, f[1], f[0]]
+                alpha[A][I][L][:, : N - k, k] = arcs_l
+                alpha[B][I][L][:, k:N, N - k - 1] = arcs_l
+                split[I][L][:, : N - k, k] = r
+
+                arcs_r = x + arc_scores[:, f[0], f[1]]
+                alpha[A][I][R][:, : N - k, k] = arcs_r
+                alpha[B][I][R][:, k:N, N - k - 1] = arcs_r
+                split[I][R][:, : N - k, k] = r
+
+                ACL = alpha[A][C][L][:, : N - k, :k]
+                BCR = alpha[B][C][R][:, k:, N - k :]
+                AIR = alpha[A][I][R][:, : N - k, 1 : k + 1]
+                BIL = alpha[B][I][L][:, k:, N - k - 1 : N - 1]
+
+                new, r = (ACL + BIL).max(-1)
+                alpha[A][C][L][:, : N - k, k] = new
+                alpha[B][C][L][:, k:N, N - k - 1] = new
+                split[C][L][:, : N - k, k] = r
+
+                new, r = (AIR + BCR).max(-1)
+                alpha[A][C][R][:, : N - k, k] = new
+                alpha[B][C][R][:, k:N, N - k - 1] = new
+                split[C][R][:, : N - k, k] = r + 1
+
+            # Top-down over (batch, start, end, complete, direction) items.
+            heads = lengths.new_zeros((batch, N))
+            b = torch.arange(batch, device=arc_scores.device)
+            s, e = torch.zeros_like(lengths), lengths
+            c, d = torch.ones_like(lengths), torch.ones_like(lengths)
+            while b.shape[0] > 0:
+                k = e - s
+                live = k > 0
+                b, s, e, c, d, k = (x[live] for x in (b, s, e, c, d, k))
+                inc = c == I
+                arc_l, arc_r = inc & (d == L), inc & (d == R)
+                heads[b[arc_l], s[arc_l]] = e[arc_l]
+                heads[b[arc_r], e[arc_r]] = s[arc_r]
+                r = s + split[c, d, b, s, k]
+
+                # Incomplete [s, e] -> C R [s, r] + C L [r + 1, e]
+                # C L [s, e] -> C L [s, r] + I L [r, e]
+                # C R [s, e] -> I R [s, r] + C R [r, e]
+                left_c = torch.where(inc, torch.ones_like(c), 1 - d)
+                left_d = torch.where(inc, torch.ones_like(d), d)
+                right_s = torch.where(inc, r + 1, r)
+                right_c = torch.where(inc, torch.ones_like(c), d)
+                right_d = torch.where(inc, torch.zeros_like(d), d)
+                b = torch.cat([b, b])
+                s, e = torch.cat([s, right_s]), torch.cat([r, e])
+                c, d = torch.cat([left_c, right_c]), torch.cat([left_d, right_d])
+            return heads[:, 1:]
 
     @staticmethod
     def to_parts(sequence, extra=None, lengths=None):
@@ -7,6 +7,7 @@ from .semimarkov import SemiMarkov
 from .alignment import Alignment
 from .deptree import DepTree, deptree_nonproj, deptree_part
 from .cky_crf import CKY_CRF
+from .ctc import CTC
 from .semirings import (
     LogSemiring,
     MaxSemiring,
@@ -222,7 +223,9 @@ class AlignmentCRF(StructDistribution):
                                   Ops are 0 -> j-1, 1->i-1,j-1, and 2->i-1
         local (bool): if true computes local alignment (Smith-Waterman), else Needleman-Wunsch
         max_gap (int or None): the maximum gap to allow in the dynamic program
-        lengths (long tensor) : batch shape integers for length masking.
+        lengths (long tensor) : batch shape integers for length masking of N, or
+                                batch shape x 2 (N, M) lengths of ragged pairs.
+        engine (str) : "scan" or "wavefront", see :class:`Alignment`
 
 
     Implementation uses convolution and linear-scan. Use max_gap for long sequences.
@@ -230,17 +233,89 @@ class AlignmentCRF(StructDistribution):
     * Parallel Time: :math:`O(\log (M + N))` parallel merges.
     * Forward Memory: :math:`O((M+N)^2)`
 
+    The wavefront engine sweeps the anti-diagonals sequentially.
+
+    * Parallel Time: :math:`O(M + N)` steps.
+    * Forward Memory: :math:`O((M+N)^2)`, or :math:`O((M+N) \cdot gap)` with max_gap.
+
     """
     struct = Alignment
 
-    def __init__(self, log_potentials, local=False, lengths=None, max_gap=None):
+    def __init__(
+        self, log_potentials, local=False, lengths=None, max_gap=None, engine="scan"
+    ):
         self.local = local
         self.max_gap = max_gap
+        self.engine = engine
+        super().__init__(log_potentials, lengths)
+
+    def _struct(self, sr=None):
+        return self.struct(
+            sr if sr is not None else LogSemiring,
+            local=self.local,
+            max_gap=self.max_gap,
+            engine=self.engine,
+        )
+
+    @lazy_property
+    def decode(self):
+        r"""
+        Compute the argmax alignment by max-plus dynamic programming with
+        backpointers.
+
+        Returns:
+            path (*batch_shape x (N + M - 1) x 3*) : (i, j, op) of the cells
+                                                     of the alignment, padded with -1
+            score (*batch_shape*) : score of the alignment
+        """
+        return self._struct(MaxSemiring).decode(self.log_potentials, self.lengths)
+
+
+class CTCCRF(StructDistribution):
+    r"""
+    Represents connectionist temporal classification (CTC) alignments of
+    T frames to a target sequence of L labels.
+
+    For reference see:
+
+    * Connectionist temporal classification :cite:`graves2006connectionist`
+
+    Event shape is of the form:
+
+    Parameters:
+        log_potentials (tensor) : event shape (*T x V*) e.g.
+                                  :math:`\phi(t, z_t)` frame log-probabilities
+        targets (long tensor) : batch shape x L target labels
+        lengths (long tensor) : batch shape integers for frame masking.
+        target_lengths (long tensor) : batch shape integers for target masking.
+        blank (int) : blank label
+
+    Compact representation: T long tensor of frame labels in [0, ..., V-1]
+
+    Implementation uses a sequential forward pass over the frames. The
+    partition is the log-likelihood of the targets, i.e. the negated CTC loss.
+
+    * Parallel Time: :math:`O(T)` steps.
+    * Forward Memory: :math:`O(T L)`
+
+    """
+
+    struct = CTC
+
+    def __init__(
+        self, log_potentials, targets, lengths=None, target_lengths=None, blank=0
+    ):
+        self.targets = targets
+        self.target_lengths = target_lengths
+        self.blank = blank
         super().__init__(log_potentials, lengths)
 
     def _struct(self, sr=None):
         return self.struct(
-            sr if sr is not None else LogSemiring, self.local, max_gap=self.max_gap
+            sr if sr is not None else LogSemiring,
+            self.targets,
+            self.target_lengths,
+            self.blank,
         )
 
 
@@ -319,6 +394,26 @@ class DependencyCRF(StructDistribution):
 
     struct = DepTree
 
+    @lazy_property
+    def decode(self):
+        r"""
+        Compute the argmax tree :math:`\arg\max p(z)` by Eisner with backpointers.
+
+        Returns:
+            sequence (*batch_shape x N*) : heads in [0, N] (indexing is +1)
+        """
+        return self._struct(MaxSemiring).decode(self.log_potentials, self.lengths)
+
+    def mbr(self):
+        r"""
+        Compute the minimum Bayes risk tree, maximizing the expected number
+        of correct arcs, by one max-plus pass over the cached marginals.
+
+        Returns:
+            sequence (*batch_shape x N*) : heads in [0, N] (indexing is +1)
+        """
+        return self._struct(MaxSemiring).decode(self.marginals, self.lengths)
+
 
 class TreeCRF(StructDistribution):
     r"""
@@ -335,16 +430,59 @@ class TreeCRF(StructDistribution):
         log_potentials (tensor) : event_shape (*N x N x NT*), e.g.
                                     :math:`\phi(i, j, nt)`
         lengths (long tensor) : batch shape integers for length masking.
+        max_width (int) : if given, spans wider than max_width must be
+                          prefixes [0, j), i.e. a left-branching spine closes
+                          the tree over bounded spans.
+        keep (bool tensor) : batch shape x (*N x N*) or (*N x N x NT*) mask of
+                             the spans / labels kept after pruning, e.g. from
+                             :meth:`CKY_CRF.prune`.
 
     Implementation uses width-batched, forward-pass only
 
     * Parallel Time: :math:`O(N)` parallel merges.
     * Forward Memory: :math:`O(N^2)`
+    * Bounded Width Time: :math:`O(N W^2)` for max_width W
 
     Compact representation:  *N x N x NT* long tensor (Same)
     """
     struct = CKY_CRF
 
+    def __init__(self, log_potentials, lengths=None, max_width=None, keep=None):
+        self.max_width = max_width
+        self.keep = keep
+        super().__init__(log_potentials, lengths)
+
+    def _struct(self, sr=None):
+        return self.struct(
+            sr if sr is not None else LogSemiring,
+            max_width=self.max_width,
+            keep=self.keep,
+        )
+
+    @lazy_property
+    def decode(self):
+        r"""
+        Compute the argmax tree :math:`\arg\max p(z)` by CKY with backpointers.
+
+        Returns:
+            spans (*batch_shape x (2N-1) x 3*) : (start, end, label) of the spans
+                                                 top-down, end inclusive, padded
+                                                 with -1
+        """
+        return self._struct(MaxSemiring).decode(self.log_potentials, self.lengths)
+
+    def mbr(self):
+        r"""
+        Compute the minimum Bayes risk tree, maximizing the expected labeled
+        span recall, by one max-plus pass over the cached marginals.
+
+        Returns:
+            spans (*batch_shape x (2N-1) x 3*) : (start, end, label) of the spans
+                                                 top-down, end inclusive, padded
+                                                 with -1
+        """
+        return self._struct(MaxSemiring).decode(self.marginals, self.lengths)
+
 
 class SentCFG(StructDistribution):
     """
@@ -359,26 +497,79 @@ class SentCFG(StructDistribution):
                          rules (*NT x (NT+T) x (NT+T)*)
                          root  (*NT*)
         lengths (long tensor) : batch shape integers for length masking.
+        max_width (int) : if given, spans wider than max_width must be
+                          prefixes [0, j), i.e. a left-branching spine closes
+                          the tree over bounded spans.
+        keep (bool tensor) : batch shape x (*N x N*) span mask or (*N x N x NT*)
+                             nonterminal beam kept after pruning.
+
+    Rules may also be given as a rank-R CP decomposition, a tuple of
+    parent (*NT x R*), left (*(NT+T) x R*) and right (*(NT+T) x R*)
+    log-factors. Rule marginals are then returned in the same factored form.
+
+    Sparse grammars may give the rules as a list (parent, left, right, score)
+    of n long indices and a *n* score tensor. The width steps then score
+    only the P distinct child pairs of the listed rules and sum each rule
+    into its parent, and rule marginals are returned as a list with *n*
+    marginals.
 
     Implementation uses width-batched, forward-pass only
 
     * Parallel Time: :math:`O(N)` parallel merges.
     * Forward Memory: :math:`O(N^2 (NT+T))`
+    * Low-rank Time: :math:`O(N^3 R + N^2 (NT+T) R)`
+    * Rule List Time: :math:`O(N^3 P + N^2 n)` for n rules over P child pairs
+    * Bounded Width Time: :math:`O(N W^2 NT (NT+T)^2)` for max_width W
+    * Prefix Probability Time: :math:`O(N^3 (NT+T)^2 + N^2 NT (NT+T)^2)`, one
+      token at a time
 
     Compact representation:  (*N x N x NT*) long tensor
     """
 
     struct = CKY
 
-    def __init__(self, log_potentials, lengths=None):
+    def __init__(self, log_potentials, lengths=None, max_width=None, keep=None):
         batch_shape = log_potentials[0].shape[:1]
         event_shape = log_potentials[0].shape[1:]
         self.log_potentials = log_potentials
         self.lengths = lengths
+        self.max_width = max_width
+        self.keep = keep
         super(StructDistribution, self).__init__(
             batch_shape=batch_shape, event_shape=event_shape
         )
 
+    def _struct(self, sr=None):
+        return self.struct(
+            sr if sr is not None else LogSemiring,
+            max_width=self.max_width,
+            keep=self.keep,
+        )
+
+    @lazy_property
+    def decode(self):
+        r"""
+        Compute the argmax tree :math:`\arg\max p(z)` by CKY with backpointers.
+
+        Returns:
+            spans (*batch_shape x (2N-1) x 3*) : (start, end, label) of the spans
+                                                 top-down, end inclusive, padded
+                                                 with -1
+        """
+        return self._struct(MaxSemiring).decode(self.log_potentials, self.lengths)
+
+    @lazy_property
+    def prefixes(self):
+        r"""
+        Compute the prefix probabilities :math:`\log p(x_1 \ldots x_j \ldots)`
+        of a proper PCFG by incremental CKY. For streaming see
+        :meth:`CKY.prefix_iter`.
+
+        Returns:
+            prefixes (*batch_shape x N*) : padded with 0 past each length
+        """
+        return self.struct().prefixes(self.log_potentials, self.lengths)
+
 
 class NonProjectiveDependencyCRF(StructDistribution):
     r"""
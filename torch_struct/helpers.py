@@ -4,70 +4,341 @@ from .semirings import LogSemiring
 from torch.autograd import Function
 
 
-class Get(torch.autograd.Function):
-    @staticmethod
-    def forward(ctx, chart, grad_chart, indices):
-        ctx.save_for_backward(grad_chart)
-        out = chart[indices]
-        ctx.indices = indices
-        return out
+def _keeps_dim(i):
+    return not isinstance(i, int) and not (torch.is_tensor(i) and i.dim() == 0)
+
+
+def _span_index(keep, D):
+    """
+    Batch and start indices of the kept spans of width w + 1, for w < D,
+    given a *batch x N x N (x NT)* keep mask.
+    """
+    if keep.dim() == 4:
+        keep = keep.any(-1)
+    return [keep.diagonal(w, 1, 2).nonzero(as_tuple=True) for w in range(D)]
+
+
+def _scatter(semiring, x, shape, index):
+    "Place the values `x` of the kept spans into a semiring zero tensor."
+    out = semiring.zero_(x.new_empty(shape))
+    out[(slice(None),) + index] = x
+    return out
+
+
+def _traceback(N, roots, children):
+    """
+    Top-down traceback of the best binary trees, one tree level at a time.
+
+    Parameters:
+        N : max length
+        roots : (batch, width, label) long tensors of the root spans [0, width)
+        children : callable `children(b, start, width, label)` giving the left
+                   child width and the left and right child labels of the
+                   spans, all of width > 1
+
+    Returns:
+        spans : batch x (2N - 1) x 3 long tensor of (start, end, label) of the
+                spans top-down, end inclusive, padded with -1
+    """
+    b, w, l = roots
+    s = torch.zeros_like(w)
+    nodes = []
+    while len(b) > 0:
+        nodes.append(torch.stack([b, s, s + w - 1, l], dim=-1))
+        inner = w > 1
+        b, s, w, l = b[inner], s[inner], w[inner], l[inner]
+        left, left_l, right_l = children(b, s, w, l)
+        b, s = torch.cat([b, b]), torch.cat([s, s + left])
+        w, l = torch.cat([left, w - left]), torch.cat([left_l, right_l])
+
+    # Place the spans of each tree in order.
+    nodes = torch.cat(nodes, dim=0)
+    batch = len(roots[0])
+    M = nodes.shape[0]
+    order = torch.argsort(nodes[:, 0] * M + torch.arange(M, device=nodes.device))
+    nodes = nodes[order]
+    counts = torch.bincount(nodes[:, 0], minlength=batch)
+    pos = (
+        torch.arange(M, device=nodes.device) - (counts.cumsum(0) - counts)[nodes[:, 0]]
+    )
+    spans = nodes.new_full((batch, 2 * N - 1, 3), -1)
+    spans[nodes[:, 0], pos] = nodes[:, 1:]
+    return spans
 
-    @staticmethod
-    def backward(ctx, grad_output):
-        grad_chart, = ctx.saved_tensors
-        grad_chart[ctx.indices] += grad_output
-        return grad_chart, None, None
 
+class Chart:
+    """
+    Span chart stored diagonal-major.
 
-class Set(torch.autograd.Function):
-    @staticmethod
-    def forward(ctx, chart, indices, vals):
-        chart[indices] = vals
-        ctx.indices = indices
-        return chart
-
-    @staticmethod
-    def backward(ctx, grad_output):
-        z = grad_output[ctx.indices]
-        return None, None, z
+    Cells are addressed as `chart[pos, diag, ...]`, e.g. (start, width) or
+    (end, N - 1 - width), and returned as *ssize x batch x pos x diag x ...*.
+    They are stored as *diag x ssize x batch x pos x ...* so that each width
+    step of a DP reads and writes contiguous blocks.
 
+    Charts are filled without autograd by a :class:`ChartDP`. Gradient
+    storage is only allocated if the DP is differentiated.
+    """
 
-class Chart:
-    def __init__(self, size, potentials, semiring, cache=True):
-        self.data = semiring.zero_(
+    def __init__(self, size, potentials, semiring):
+        batch, N, D = size[:3]
+        self.semiring = semiring
+        self.data = self.zero_(
+            semiring,
             torch.zeros(
-                *((semiring.size(),) + size),
+                *((D, semiring.size(), batch, N) + size[3:]),
                 dtype=potentials.dtype,
                 device=potentials.device
-            )
+            ),
         )
-        self.grad = self.data.detach().clone().fill_(0.0)
-        self.cache = cache
+        self.grad = None
+        self.mode = None
+        self.block = None
 
-    def __getitem__(self, ind):
+    @staticmethod
+    def zero_(semiring, data):
+        "Fill *diag x ssize x ...* data with semiring zeros."
+        semiring.zero_(data.transpose(0, 1))
+        return data
+
+    @staticmethod
+    def _index(ind):
+        if not isinstance(ind, tuple):
+            ind = (ind,)
+        ind = ind + (slice(None),) * (2 - len(ind))
+        pos, diag = ind[:2]
         I = slice(None)
-        if self.cache:
-            return Get.apply(self.data, self.grad, (I, I) + ind)
-        else:
-            return self.data[(I, I) + ind]
+        return (diag, I, I, pos) + ind[2:]
+
+    @staticmethod
+    def _diag_dim(index):
+        return 3 if _keeps_dim(index[3]) else 2
+
+    def __getitem__(self, ind):
+        index = self._index(ind)
+        v = self.data[index]
+        if self.mode == "record":
+            v = v.detach().requires_grad_(True)
+            self.reads.append((index, v))
+            v = self._overlay(index, v)
+        elif self.mode == "graph":
+            v = v.clone()
+        if _keeps_dim(index[0]):
+            v = v.movedim(0, self._diag_dim(index))
+        return v
 
     def __setitem__(self, ind, new):
-        I = slice(None)
-        if self.cache:
-            self.data = Set.apply(self.data, (I, I) + ind, new)
+        index = self._index(ind)
+        if _keeps_dim(index[0]):
+            new = new.movedim(self._diag_dim(index), 0)
+        if self.mode != "record":
+            self.data[index] = new
+            return
+        self.writes.append((index, new))
+        if self.block is not None:
+            diag = index[0] % self.data.shape[0]
+            if diag not in self.block:
+                row = self.data[diag].detach().requires_grad_(True)
+                self.reads.append(((diag,), row))
+                self.block[diag] = row
+            row = self.block[diag].clone()
+            row[index[1:]] = new
+            self.block[diag] = row
+
+    def _overlay(self, index, v):
+        "Replace diagonals written earlier in the recomputed block."
+        if not self.block:
+            return v
+        D = self.data.shape[0]
+        if not _keeps_dim(index[0]):
+            row = self.block.get(index[0] % D)
+            return v if row is None else row[index[1:]]
+        diags = range(D)[index[0]]
+        if not any((d in self.block for d in diags)):
+            return v
+        return torch.stack(
+            [
+                self.block[d][index[1:]] if d in self.block else v[i]
+                for i, d in enumerate(diags)
+            ]
+        )
+
+    def grad_of(self, index):
+        if self.grad is None:
+            self.grad = torch.zeros_like(self.data)
+        return self.grad[index]
+
+    def accumulate_grad(self, index, g):
+        self.grad_of(index)
+        self.grad[index] += g
+
+
+class ChartDP:
+    """
+    Run a chart dynamic program as a single autograd node.
+
+    Parameters:
+        charts : list of :class:`Chart` written by the program
+        stages : list of callables `stage(*inputs)` reading and writing the
+                 charts. The last one returns the result. A stage may not
+                 read cells written by the same stage.
+        checkpoint : number of stages recomputed together in backward, or
+                     0 to keep the full autograd graph instead
+
+    The forward pass keeps no graph, only the charts. Backward sweeps the
+    stages in reverse, recomputing `checkpoint` stages at a time with their
+    chart reads as leaves. Larger blocks trade memory for fewer backward
+    calls. Second order gradients (`create_graph=True`) recompute the full
+    program with a graph instead.
+    """
+
+    def __init__(self, charts, stages, checkpoint=1):
+        self.charts = charts
+        self.stages = stages
+        self.checkpoint = checkpoint
+
+    def __call__(self, *inputs):
+        if not self.checkpoint:
+            return self._graph(inputs)
+        return _ChartDP.apply(self, *inputs)
+
+    def _run(self, inputs):
+        for stage in self.stages[:-1]:
+            stage(*inputs)
+        return self.stages[-1](*inputs)
+
+    def _graph(self, inputs):
+        for c in self.charts:
+            c.mode = "graph"
+        v = self._run(inputs)
+        for c in self.charts:
+            c.mode = None
+        return v
+
+    def _backward(self, inputs, grad_output, needs_grad):
+        inputs = [x.detach().requires_grad_(n) for x, n in zip(inputs, needs_grad)]
+        wrt = [x for x in inputs if x.requires_grad]
+        grad_inputs = [None] * len(wrt)
+        for c in self.charts:
+            c.mode = "record"
+
+        n_stages = len(self.stages)
+        for end in range(n_stages, 0, -self.checkpoint):
+            for c in self.charts:
+                c.reads, c.writes = [], []
+                c.block = {} if self.checkpoint > 1 else None
+            with torch.enable_grad():
+                for n in range(max(end - self.checkpoint, 0), end):
+                    out = self.stages[n](*inputs)
+
+            outputs, grads = [], []
+            if end == n_stages:
+                outputs, grads = [out], [grad_output]
+            for c in self.charts:
+                for index, v in c.writes:
+                    if v.requires_grad:
+                        outputs.append(v)
+                        grads.append(c.grad_of(index))
+            reads = [(c, index, v) for c in self.charts for index, v in c.reads]
+            if not outputs:
+                continue
+            g = torch.autograd.grad(
+                outputs, [v for _, _, v in reads] + wrt, grads, allow_unused=True
+            )
+            for (c, index, _), g_read in zip(reads, g):
+                if g_read is not None:
+                    c.accumulate_grad(index, g_read)
+            for i, g_in in enumerate(g[len(reads) :]):
+                if g_in is not None:
+                    grad_inputs[i] = (
+                        g_in if grad_inputs[i] is None else grad_inputs[i] + g_in
+                    )
+
+        for c in self.charts:
+            c.mode, c.reads, c.writes, c.block, c.grad = None, None, None, None, None
+        grad_inputs = iter(grad_inputs)
+        return [next(grad_inputs) if n else None for n in needs_grad]
+
+    def _double_backward(self, inputs, grad_output):
+        saved = [c.data for c in self.charts]
+        for c in self.charts:
+            c.data = Chart.zero_(c.semiring, torch.zeros_like(c.data))
+        v = self._graph(inputs)
+        for c, data in zip(self.charts, saved):
+            c.data = data
+        wrt = [x for x in inputs if x.requires_grad]
+        grads = iter(
+            torch.autograd.grad(
+                v, wrt, grad_output, create_graph=True, allow_unused=True
+            )
+        )
+        return [next(grads) if x.requires_grad else None for x in inputs]
+
+
+class _ChartDP(Function):
+    @staticmethod
+    def forward(ctx, dp, *inputs):
+        ctx.dp = dp
+        ctx.save_for_backward(*inputs)
+        return dp._run(inputs)
+
+    @staticmethod
+    def backward(ctx, grad_output):
+        inputs = ctx.saved_tensors
+        if torch.is_grad_enabled():
+            grads = ctx.dp._double_backward(inputs, grad_output)
         else:
-            self.data[(I, I) + ind] = new
+            grads = ctx.dp._backward(inputs, grad_output, ctx.needs_input_grad[1:])
+        return (None,) + tuple(grads)
+
 
-    def get(self, ind):
-        return Get.apply(self.data, self.grad, ind)
+class _Marginals(Function):
+    """
+    Marginals computed without keeping a second-order graph.
 
-    def set(self, ind, new):
-        self.data = Set.apply(self.data, ind, new)
+    Gradients of the marginals are opt-in: backward recomputes them with
+    `create_graph=True`.
+    """
+
+    @staticmethod
+    def forward(ctx, struct, lengths, pack, *potentials):
+        ctx.struct, ctx.lengths, ctx.pack = struct, lengths, pack
+        ctx.save_for_backward(*potentials)
+        potentials = [x.detach() for x in potentials]
+        with torch.enable_grad():
+            marg = struct._marginals(pack(potentials), lengths)
+        if torch.is_tensor(marg):
+            return marg.detach()
+        return tuple((m.detach() for m in marg))
+
+    @staticmethod
+    def backward(ctx, *grad_output):
+        potentials = [x.detach().requires_grad_(True) for x in ctx.saved_tensors]
+        with torch.enable_grad():
+            marg = ctx.struct._marginals(
+                ctx.pack(potentials), ctx.lengths, create_graph=True
+            )
+        if torch.is_tensor(marg):
+            marg = (marg,)
+        outputs = [(m, g) for m, g in zip(marg, grad_output) if m.requires_grad]
+        if not outputs:
+            return (None, None, None) + (None,) * len(potentials)
+        grads = torch.autograd.grad(
+            [m for m, _ in outputs],
+            potentials,
+            [g for _, g in outputs],
+            allow_unused=True,
+        )
+        return (None, None, None) + grads
 
 
 class _Struct:
-    def __init__(self, semiring=LogSemiring):
+    # Structs run on ChartDP return marginals from _Marginals, so that
+    # gradients of the marginals are only paid for when requested.
+    _chart_marginals = False
+
+    def __init__(self, semiring=LogSemiring, checkpoint=1):
         self.semiring = semiring
+        self.checkpoint = checkpoint
 
     def score(self, potentials, parts, batch_dims=[0]):
         score = torch.mul(potentials, parts)
@@ -152,6 +423,8 @@ class _Struct:
             or self.semiring is not LogSemiring
             or not hasattr(self, "_dp_backward")
         ):
+            if self._chart_marginals and not _raw:
+                return _Marginals.apply(self, lengths, lambda ps: ps[0], edge)
             v, edges, _ = self._dp(edge, lengths=lengths, force_grad=True)
             if _raw:
                 all_m = []
@@ -172,12 +445,23 @@ class _Struct:
                 marg = torch.autograd.grad(
                     obj, edges, create_graph=True, only_inputs=True, allow_unused=False
                 )
+                marg = [self.semiring.marginals(e, m) for e, m in zip(edges, marg)]
                 a_m = self._arrange_marginals(marg)
                 return self.semiring.unconvert(a_m)
         else:
             v, _, alpha = self._dp(edge, lengths=lengths, force_grad=True)
             return self._dp_backward(edge, lengths, alpha)
 
+    def _marginals(self, edge, lengths=None, create_graph=False):
+        v, edges, _ = self._dp(edge, lengths=lengths, force_grad=True)
+        obj = self.semiring.unconvert(v).sum(dim=0)
+        marg = torch.autograd.grad(
+            obj, edges, create_graph=create_graph, only_inputs=True, allow_unused=False
+        )
+        marg = [self.semiring.marginals(e, m) for e, m in zip(edges, marg)]
+        a_m = self._arrange_marginals(marg)
+        return self.semiring.unconvert(a_m)
+
     @staticmethod
     def to_parts(spans, extra, lengths=None):
         return spans
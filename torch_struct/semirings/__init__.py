@@ -1,5 +1,6 @@
 from .semirings import (
     LogSemiring,
+    ScaledSemiring,
     StdSemiring,
     KMaxSemiring,
     MaxSemiring,
@@ -16,6 +17,8 @@ from .sparse_max import SparseMaxSemiring
 
 from .sample import MultiSampledSemiring, SampledSemiring
 
+from .banded import BandedMatrix
+
 
 # For flake8 compatibility.
 __all__ = [
@@ -23,6 +26,7 @@ __all__ = [
     FastMaxSemiring,
     FastSampleSemiring,
     LogSemiring,
+    ScaledSemiring,
     StdSemiring,
     SampledSemiring,
     MaxSemiring,
@@ -33,4 +37,5 @@ __all__ = [
     CheckpointSemiring,
     CheckpointShardSemiring,
     TempMax,
+    BandedMatrix,
 ]
@@ -0,0 +1,200 @@
+import torch
+import torch.nn.functional as F
+
+has_genbmm = False
+try:
+    import genbmm
+
+    has_genbmm = True
+except ImportError:
+    pass
+
+
+def _view(x, size, stride, offset=0):
+    "Strided view of the trailing dims of a contiguous copy of x."
+    x = x.contiguous()
+    n = x.dim() - 2
+    return x.as_strided(
+        x.shape[:n] + size, x.stride()[:n] + stride, x.storage_offset() + offset
+    )
+
+
+class BandedMatrix:
+    """
+    Batched banded *n x n* matrices, a native counterpart of
+    `genbmm.BandedMatrix` built on strided views.
+
+    Row i of `data` holds the band of row i of the dense matrix,
+    ``dense[..., i, i + j - lu] = data[..., i, j]``. Cells outside of the
+    matrix hold `fill`, the semiring zero.
+
+    Parameters:
+        data : ... x n x (lu + ld + 1) bands
+        lu : diagonals left of the main diagonal
+        ld : diagonals right of the main diagonal
+        fill : value of the cells outside of the band
+    """
+
+    def __init__(self, data, lu, ld, fill=0):
+        assert data.shape[-1] == lu + ld + 1, "Band width must be lu + ld + 1"
+        self.data = data
+        self.lu, self.ld = lu, ld
+        self.width = lu + ld + 1
+        self.fill = fill
+
+    @classmethod
+    def from_dense(cls, dense, lu, ld, fill=0):
+        "Band of a dense ... x n x n matrix."
+        n, w = dense.shape[-1], lu + ld + 1
+        x = F.pad(dense, (lu, ld), value=fill)
+        return cls(_view(x, (n, w), (n + w, 1)), lu, ld, fill)
+
+    def to_dense(self):
+        "Dense ... x n x n matrix."
+        n, w = self.data.shape[-2], self.width
+        x = self.data.new_full(self.data.shape[:-1] + (n + w - 1,), self.fill)
+        _view(x, (n, w), (n + w, 1)).copy_(self.data)
+        return x[..., self.lu : self.lu + n]
+
+    def _masked(self):
+        "Data with the cells outside of the matrix set to `fill`."
+        n = self.data.shape[-2]
+        col = (
+            torch.arange(n, device=self.data.device)[:, None]
+            + torch.arange(self.width, device=self.data.device)
+            - self.lu
+        )
+        return self.data.masked_fill((col < 0) | (col >= n), self.fill)
+
+    def transpose(self):
+        n, w = self.data.shape[-2], self.width
+        x = F.pad(self.data, (0, 0, self.ld, self.lu), value=self.fill)
+        # data'[i, j] = data[i + j - ld, w - 1 - j]
+        return BandedMatrix(
+            _view(x, (n, w), (w, w - 1), w - 1), self.ld, self.lu, self.fill
+        )
+
+    def col_shift(self, t):
+        "Shift the rows up by t, i.e. dense'[i, c] = dense[i + t, c]."
+        if t == 0:
+            return self
+        if t > 0:
+            v = F.pad(self.data[..., t:, :], (0, 0, 0, t), value=self.fill)
+        else:
+            v = F.pad(self.data[..., :t, :], (0, 0, -t, 0), value=self.fill)
+        return BandedMatrix(v, self.lu - t, self.ld + t, self.fill)
+
+    def band_shift(self, t):
+        "Move the band t diagonals to the right, dropping the leftmost."
+        if t == 0:
+            return self
+        if t > 0:
+            v = F.pad(self.data[..., t:], (0, t), value=self.fill)
+        else:
+            v = F.pad(self.data[..., :t], (-t, 0), value=self.fill)
+        return BandedMatrix(v, self.lu - t, self.ld + t, self.fill)
+
+    def band_pad(self, t):
+        "Widen the band by t diagonals of `fill` on each side."
+        if t == 0:
+            return self
+        v = F.pad(self.data, (t, t), value=self.fill)
+        return BandedMatrix(v, self.lu + t, self.ld + t, self.fill)
+
+    def _multiply(self, other, kind):
+        """
+        Semiring product `self @ other^T`, with band lu = self.lu + other.ld
+        and ld = self.ld + other.lu.
+
+        out[i, m] = sum_p self[i, p] * other[i + m - lu, p - m + other.width - 1]
+        is read from a strided view of the padded `other`, so the cost is
+        O(n x out.width x self.width) (see :class:`_BandedMatmul`).
+        """
+        lu, ld = self.lu + other.ld, self.ld + other.lu
+        y = F.pad(other._masked(), (self.width - 1,) * 2 + (lu, ld), value=other.fill)
+        out = _BandedMatmul.apply(self._masked(), y, lu + ld + 1, kind)
+        return BandedMatrix(out, lu, ld, self.fill)
+
+    def multiply(self, other):
+        return self._multiply(other, "sum")
+
+    def multiply_log(self, other):
+        return self._multiply(other, "log")
+
+    def multiply_max(self, other):
+        return self._multiply(other, "max")
+
+
+class _BandedMatmul(torch.autograd.Function):
+    """
+    Band product of :meth:`BandedMatrix._multiply`, `x` the *n x w_x* bands
+    and `y` the padded bands of the other matrix. The w_x terms of each
+    output cell are reduced one at a time into a running sum, logsumexp or
+    max, so memory stays at the *n x w_c* output. Backward recomputes the
+    terms in the same order.
+    """
+
+    @staticmethod
+    def _terms(x, y, w_c, kind):
+        n, w_x = x.shape[-2:]
+        wp = y.shape[-1]
+        y = _view(y, (n, w_c, w_x), (wp, wp - 1, 1), w_c - 1)
+        times = torch.mul if kind == "sum" else torch.add
+        for p in range(w_x):
+            yield p, y[..., p], times(x[..., p, None], y[..., p])
+
+    @staticmethod
+    def forward(ctx, x, y, w_c, kind):
+        out = arg = None
+        for p, _, t in _BandedMatmul._terms(x, y, w_c, kind):
+            if out is None:
+                out = t
+                if kind == "max":
+                    arg = torch.zeros(t.shape, dtype=torch.long, device=t.device)
+            elif kind == "sum":
+                out = out + t
+            elif kind == "log":
+                out = torch.maximum(out, t)
+            else:
+                better = t > out
+                out = torch.where(better, t, out)
+                arg = arg.masked_fill(better, p)
+        if kind == "log":
+            # Second pass: sum of the terms shifted by their max.
+            m = out.masked_fill(out == -float("inf"), 0)
+            out = torch.zeros_like(m)
+            for _, _, t in _BandedMatmul._terms(x, y, w_c, kind):
+                out += (t - m).exp()
+            out = out.log() + m
+        ctx.save_for_backward(x, y, out, arg)
+        ctx.w_c, ctx.kind = w_c, kind
+        return out
+
+    @staticmethod
+    def backward(ctx, grad_output):
+        x, y, out, arg = ctx.saved_tensors
+        kind = ctx.kind
+        grad_x, grad_y = torch.zeros_like(x), torch.zeros_like(y)
+        n, w_x = x.shape[-2:]
+        wp = y.shape[-1]
+        # Cells (i, m) of one term p are distinct, so the view can be added to.
+        grad_yv = _view(grad_y, (n, ctx.w_c, w_x), (wp, wp - 1, 1), ctx.w_c - 1)
+        for p, y_p, t in _BandedMatmul._terms(x, y, ctx.w_c, kind):
+            if kind == "sum":
+                g_x, g_y = grad_output * y_p, grad_output * x[..., p, None]
+            else:
+                if kind == "log":
+                    g_y = grad_output * (t - out).exp()
+                else:
+                    g_y = grad_output.masked_fill(arg != p, 0)
+                g_x = g_y
+            grad_x[..., p] += g_x.sum(-1).sum_to_size(grad_x[..., p].shape)
+            grad_yv[..., p] += g_y.sum_to_size(grad_yv[..., p].shape)
+        return grad_x, grad_y, None, None
+
+
+def is_banded(a):
+    "Whether `a` is a native or a genbmm banded matrix."
+    return isinstance(a, BandedMatrix) or (
+        has_genbmm and isinstance(a, genbmm.BandedMatrix)
+    )
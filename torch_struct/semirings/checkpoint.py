@@ -1,10 +1,5 @@
 import torch
-
-try:
-    import genbmm
-    from genbmm import BandedMatrix
-except ImportError:
-    pass
+from .banded import is_banded
 
 
 def broadcast_size(a, b):
@@ -12,10 +7,14 @@ def broadcast_size(a, b):
 
 
 def matmul_size(a, b):
-    size = [max(i, j) for i, j in zip(a.shape[:-2], b.shape[:-2])]
-    size.append(a.shape[-2])
-    size.append(b.shape[-1])
-    return size
+    "Size of `a @ b`, the broadcast batch of `a` and `b` then *n x m*."
+    batch = max(a.dim(), b.dim()) - 2
+    size = [1] * batch
+    for x in (a, b):
+        for i, d in enumerate(x.shape[:-2], batch - (x.dim() - 2)):
+            if d != 1:
+                size[i] = d
+    return torch.Size(size + [a.shape[-2], b.shape[-1]])
 
 
 def CheckpointSemiring(cls, min_size=0):
@@ -34,29 +33,36 @@ def CheckpointSemiring(cls, min_size=0):
 
     class _CheckBand(torch.autograd.Function):
         @staticmethod
-        def forward(ctx, a, a_lu, a_ld, b, b_lu, b_ld):
+        def forward(ctx, a, a_lu, a_ld, b, b_lu, b_ld, band):
             ctx.save_for_backward(a, b, torch.LongTensor([a_lu, a_ld, b_lu, b_ld]))
-            a = BandedMatrix(a, a_lu, a_ld)
-            b = BandedMatrix(b, b_lu, b_ld)
+            ctx.band = band
+            a = band(a, a_lu, a_ld, cls.zero)
+            b = band(b, b_lu, b_ld, cls.zero)
             return cls.matmul(a, b).data
 
         @staticmethod
         def backward(ctx, grad_output):
             a, b, bands = ctx.saved_tensors
             a_lu, a_ld, b_lu, b_ld = bands.tolist()
+            band = ctx.band
             with torch.enable_grad():
-                q = cls.matmul(BandedMatrix(a, a_lu, a_ld), BandedMatrix(b, b_lu, b_ld))
+                a = a.detach().requires_grad_(True)
+                b = b.detach().requires_grad_(True)
+                q = cls.matmul(
+                    band(a, a_lu, a_ld, cls.zero), band(b, b_lu, b_ld, cls.zero)
+                )
                 grad_a, grad_b = torch.autograd.grad(q.data, (a, b), grad_output)
-                return grad_a, None, None, grad_b, None, None
+                return grad_a, None, None, grad_b, None, None, None
 
     class _CheckpointSemiring(cls):
         @staticmethod
         def matmul(a, b):
-            if isinstance(a, genbmm.BandedMatrix):
+            if is_banded(a):
                 lu = a.lu + b.lu
                 ld = a.ld + b.ld
-                c = _CheckBand.apply(a.data, a.lu, a.ld, b.data, b.lu, b.ld)
-                return BandedMatrix(c, lu, ld, cls.zero)
+                band = type(a)
+                c = _CheckBand.apply(a.data, a.lu, a.ld, b.data, b.lu, b.ld, band)
+                return band(c, lu, ld, cls.zero)
 
             if broadcast_size(a, b) > min_size:
                 return _Check.apply(a, b)
@@ -66,33 +72,46 @@ def CheckpointSemiring(cls, min_size=0):
     return _CheckpointSemiring
 
 
-def CheckpointShardSemiring(cls, max_size, min_size=0):
+# Bytes of the intermediates of one shard of CheckpointShardSemiring, when
+# neither `max_size` nor `shard_budget` is given.
+shard_bytes = 2**28
+
+
+def CheckpointShardSemiring(cls, max_size=None, min_size=0, shard_budget=None):
+    """
+    Checkpointed semiring whose matmuls run in shards of the batch, each
+    recomputed in backward.
+
+    Parameters:
+        cls : semiring
+        max_size : shards hold `max_size // (k * k) + 2` of the batched
+                   *n x k* by *k x m* matmuls
+        min_size : matmuls of smaller broadcast size are not checkpointed
+        shard_budget : without `max_size`, cells of the *n x k x m*
+                       intermediate of one shard. Defaults to `shard_bytes`
+                       bytes of the operand dtype.
+    """
+
+    def step(a, b):
+        if max_size is not None:
+            return max_size // (b.shape[-2] * a.shape[-1]) + 2
+        size = shard_budget
+        if size is None:
+            size = shard_bytes // a.element_size()
+        return max(1, size // (a.shape[-2] * a.shape[-1] * b.shape[-1]))
+
     class _Check(torch.autograd.Function):
         @staticmethod
         def forward(ctx, a, b):
             ctx.save_for_backward(a, b)
-            size = matmul_size(a, b)
-            return accumulate_(
-                a,
-                b,
-                size,
-                lambda a, b: cls.matmul(a, b),
-                preserve=len(size),
-                step=max_size // (b.shape[-2] * a.shape[-1]) + 2,
-            )
+            return accumulate_(a, b, lambda a, b: cls.matmul(a, b), step(a, b))
 
         @staticmethod
         def backward(ctx, grad_output):
             a, b = ctx.saved_tensors
-            grad_a, grad_b = unaccumulate_(
-                a,
-                b,
-                grad_output,
-                len(grad_output.shape),
-                lambda a, b: cls.matmul(a, b),
-                step=max_size // (b.shape[-2] * a.shape[-1]) + 2,
+            return unaccumulate_(
+                a, b, grad_output, lambda a, b: cls.matmul(a, b), step(a, b)
             )
-            return grad_a, grad_b
 
     class _CheckpointSemiring(cls):
         @staticmethod
@@ -106,105 +125,64 @@ def CheckpointShardSemiring(cls, max_size, min_size=0):
     return _CheckpointSemiring
 
 
-def ones(x):
-    one = []
-    for i, v in enumerate(x.shape[:-1]):
-        if v == 1:
-            one.append(i)
-    return one
-
-
-def mind(one, inds):
-    inds = list(inds)
-    for v in one:
-        inds[v] = inds[v].clone().fill_(0)
-    return inds
-
-
-def accumulate_(a, b, size, fn, preserve, step=10000):
-    slices = []
-    total = 1
-    for s in size[:preserve]:
-        slices.append(slice(s))
-        total *= s
-    if step > total:
+def _shards(a, b, step):
+    """
+    Shards of the broadcast batch of `a @ b`.
+
+    Yields the flat batch indices [p, p + step) and the matching rows of `a`
+    and `b` viewed as *batch x n x k* and *batch x k x m*, computed by index
+    arithmetic instead of expanding the operands.
+    """
+    size = matmul_size(a, b)[:-2]
+    total = size.numel()
+    flat = []
+    for x in (a, b):
+        shape = (1,) * (len(size) - (x.dim() - 2)) + x.shape[:-2]
+        flat.append((shape, x.reshape((-1,) + x.shape[-2:])))
+    for p in range(0, total, step):
+        out = torch.arange(p, min(p + step, total), device=a.device)
+        inds = []
+        for shape, _ in flat:
+            rem, ind, stride = out, torch.zeros_like(out), 1
+            for s, d in zip(reversed(size), reversed(shape)):
+                if d != 1:
+                    ind = ind + (rem % s) * stride
+                stride *= d
+                rem = rem // s
+            inds.append(ind)
+        yield out, inds, flat[0][1], flat[1][1]
+
+
+def accumulate_(a, b, fn, step=10000):
+    size = matmul_size(a, b)[:-2]
+    if step >= size.numel():
         return fn(a, b)
 
-    ret = torch.zeros(*size, dtype=a.dtype, device=a.device)
-
-    a = a.expand(*size[:-2], a.shape[-2], a.shape[-1])
-    b = b.expand(*size[:-2], b.shape[-2], b.shape[-1])
+    ret = a.new_empty((size.numel(), a.shape[-2], b.shape[-1]))
+    for out, (a_ind, b_ind), a2, b2 in _shards(a, b, step):
+        ret[out] = fn(a2[a_ind], b2[b_ind])
+    return ret.view(size + (a.shape[-2], b.shape[-1]))
 
-    a2 = a.contiguous().view(-1, a.shape[-2], a.shape[-1])
-    b2 = b.contiguous().view(-1, b.shape[-2], b.shape[-1])
-    ret = ret.view(-1, a.shape[-2], b.shape[-1])
-    for p in range(0, ret.shape[0], step):
-        ret[p : p + step, :] = fn(a2[p : p + step], b2[p : p + step])
-    ret = ret.view(*size)
-    return ret
 
-
-def unaccumulate_(a, b, grad_output, preserve, fn, step=10000):
-    slices = []
-    total = 1
-    size = grad_output.shape[:preserve]
-    for s in grad_output.shape[:preserve]:
-        slices.append(slice(s))
-        total *= s
-
-    if step > total:
+def unaccumulate_(a, b, grad_output, fn, step=10000):
+    size = grad_output.shape[:-2]
+    if step >= size.numel():
         with torch.enable_grad():
-            a_in = a.clone().requires_grad_(True)
-            b_in = b.clone().requires_grad_(True)
-            q = fn(a, b)
-        ag, bg = torch.autograd.grad(q, (a, b), grad_output)
-        return ag, bg
-
-    a2 = a.expand(*size[:-2], a.shape[-2], a.shape[-1])
-    b2 = b.expand(*size[:-2], b.shape[-2], b.shape[-1])
-    a2 = a2.contiguous().view(-1, a.shape[-2], a.shape[-1])
-    b2 = b2.contiguous().view(-1, b.shape[-2], b.shape[-1])
-
-    a_grad = a2.clone().fill_(0)
-    b_grad = b2.clone().fill_(0)
-
-    grad_output = grad_output.view(-1, a.shape[-2], b.shape[-1])
-    for p in range(0, grad_output.shape[0], step):
+            a_in = a.detach().requires_grad_(True)
+            b_in = b.detach().requires_grad_(True)
+            q = fn(a_in, b_in)
+        return torch.autograd.grad(q, (a_in, b_in), grad_output)
+
+    # Gradients are accumulated shard by shard into operand-sized buffers.
+    a_grad = a.new_zeros((a[..., 0, 0].numel(),) + a.shape[-2:])
+    b_grad = b.new_zeros((b[..., 0, 0].numel(),) + b.shape[-2:])
+    grad_output = grad_output.reshape((-1,) + grad_output.shape[-2:])
+    for out, (a_ind, b_ind), a2, b2 in _shards(a, b, step):
         with torch.enable_grad():
-            a_in = a2[p : p + step].clone().requires_grad_(True)
-            b_in = b2[p : p + step].clone().requires_grad_(True)
+            a_in = a2[a_ind].detach().requires_grad_(True)
+            b_in = b2[b_ind].detach().requires_grad_(True)
             q = fn(a_in, b_in)
-        ag, bg = torch.autograd.grad(q, (a_in, b_in), grad_output[p : p + step])
-        a_grad[p : p + step] += ag
-        b_grad[p : p + step] += bg
-
-    a_grad = a_grad.view(*size[:-2], a.shape[-2], a.shape[-1])
-    b_grad = b_grad.view(*size[:-2], b.shape[-2], b.shape[-1])
-    a_ones = ones(a)
-    b_ones = ones(b)
-    f1, f2 = a_grad.sum(a_ones, keepdim=True), b_grad.sum(b_ones, keepdim=True)
-    return f1, f2
-
-
-# def unaccumulate_(a, b, grad_output, fn, step=10000):
-#     slices = []
-#     a_grad = a.clone().fill_(0)
-#     b_grad = b.clone().fill_(0)
-
-#     total = 1
-#     for s in grad_output.shape:
-#         slices.append(slice(s))
-#         total *= s
-#     a_one, b_one = ones(a), ones(b)
-
-#     indices = torch.tensor(np.mgrid[slices]).view(len(grad_output.shape), -1)
-
-#     for p in range(0, total, step):
-#         ind = indices[:, p : p + step].unbind()
-#         a_ind = mind(a_one, ind)
-#         b_ind = mind(b_one, ind)
-
-#         q = fn(a[tuple(a_ind)], b[tuple(b_ind)], grad_output[tuple(ind)])
-#         a_grad.index_put_(tuple(a_ind),  q, accumulate=True)
-#         b_grad.index_put_(tuple(b_ind),  q, accumulate=True)
-#     return a_grad, b_grad
+        ag, bg = torch.autograd.grad(q, (a_in, b_in), grad_output[out])
+        a_grad.index_add_(0, a_ind, ag)
+        b_grad.index_add_(0, b_ind, bg)
+    return a_grad.view(a.shape), b_grad.view(b.shape)
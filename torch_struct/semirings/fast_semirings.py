@@ -2,6 +2,7 @@ import torch
 import torch.distributions
 from .semirings import _BaseLog
 from .sample import _SampledLogSumExp
+from .banded import is_banded
 
 try:
     import genbmm
@@ -38,7 +39,7 @@ class FastLogSemiring(_BaseLog):
 
     @staticmethod
     def matmul(a, b, dims=1):
-        if isinstance(a, genbmm.BandedMatrix):
+        if is_banded(a):
             return b.multiply_log(a.transpose())
         else:
             a2, b2, size = broadcast(a, b)
@@ -1,11 +1,8 @@
+import functools
+import math
 import torch
-
-has_genbmm = False
-try:
-    import genbmm
-    has_genbmm = True
-except ImportError:
-    pass
+from .banded import is_banded
+from .checkpoint import matmul_size
 
 
 def matmul(cls, a, b):
@@ -19,6 +16,213 @@ def matmul(cls, a, b):
     return c
 
 
+class _LogMatmul(torch.autograd.Function):
+    """
+    Log-space matmul `logsumexp(a[..., :, :, None] + b[..., None, :, :], -2)`
+    by BLAS. Rows of `a` and columns of `b` are shifted by their maxima,
+    multiplied in probability space with `torch.matmul`, and logged again,
+    so no *n x k x m* tensor is built. Cells whose product underflows are
+    recomputed exactly by `logsumexp`, except cells all of whose terms have
+    a semiring zero operand: the `fill` of `zero_`, or at most
+    `_BaseLog.zero`. Those are set to zero.
+
+    The backward is written with differentiable ops, so it supports the
+    second-order gradients of marginals.
+    """
+
+    fill = -1e5
+
+    @staticmethod
+    def _shift(a, b):
+        ma = a.detach().max(-1, keepdim=True)[0]
+        mb = b.detach().max(-2, keepdim=True)[0]
+        ma = ma.masked_fill(torch.isinf(ma), 0)
+        mb = mb.masked_fill(torch.isinf(mb), 0)
+        return ma, mb, (a - ma).exp(), (b - mb).exp()
+
+    @staticmethod
+    def _underflow(a, b, under):
+        "Score terms of the underflowed cells, *cells x k*."
+        size = under.shape[:-2]
+        a = a.expand(size + a.shape[-2:])
+        b = b.expand(size + b.shape[-2:])
+        cells = under.nonzero(as_tuple=True)
+        rows, cols = cells[:-1], cells[:-2] + cells[-1:]
+        return rows, cols, a[rows] + b.transpose(-2, -1)[cols]
+
+    @staticmethod
+    def _live(x):
+        "Operands that are not semiring zeros."
+        return (x != _LogMatmul.fill) & (x > _BaseLog.zero)
+
+    @staticmethod
+    def _cells(a, b, s):
+        """
+        Cells whose scaled product underflows, split into those with a live
+        term, which are recomputed, and those without, which are zero.
+        """
+        under = s < torch.finfo(s.dtype).tiny
+        if not under.any():
+            return under, under
+        live = _LogMatmul._live(a).to(s.dtype)
+        live = torch.matmul(live, _LogMatmul._live(b).to(s.dtype)) > 0
+        return under & live, under & ~live
+
+    @staticmethod
+    def forward(ctx, a, b):
+        ma, mb, ea, eb = _LogMatmul._shift(a, b)
+        s = torch.matmul(ea, eb)
+        c = s.log() + ma + mb
+        under, dead = _LogMatmul._cells(a, b, s)
+        c.masked_fill_(dead, _BaseLog.zero)
+        if under.any():
+            _, _, terms = _LogMatmul._underflow(a, b, under)
+            c[under] = torch.logsumexp(terms, dim=-1)
+        ctx.save_for_backward(a, b, c, under, dead)
+        return c
+
+    @staticmethod
+    def backward(ctx, grad_output):
+        a, b, c, under, dead = ctx.saved_tensors
+        ma, mb, ea, eb = _LogMatmul._shift(a, b)
+        # d c_ij / d a_ik = exp(a_ik + b_kj - c_ij) = ea_ik eb_kj / s_ij
+        w = grad_output * (ma + mb - c).masked_fill(under | dead, -float("inf")).exp()
+        grad_a = ea * torch.matmul(w, eb.transpose(-2, -1))
+        grad_b = eb * torch.matmul(ea.transpose(-2, -1), w)
+        if under.any():
+            rows, cols, terms = _LogMatmul._underflow(a, b, under)
+            p = terms.softmax(-1) * grad_output[under].unsqueeze(-1)
+            size = under.shape[:-2]
+            grad_a = grad_a.expand(size + grad_a.shape[-2:]).clone()
+            grad_b = grad_b.expand(size + grad_b.shape[-2:]).clone()
+            grad_a.index_put_(rows, p, accumulate=True)
+            grad_b.transpose(-2, -1).index_put_(cols, p, accumulate=True)
+        return grad_a.sum_to_size(a.shape), grad_b.sum_to_size(b.shape)
+
+
+class _EntropyMatmul(torch.autograd.Function):
+    """
+    Entropy semiring matmul of *2 x ... x n x k* and *2 x ... x k x m*
+    log-value / entropy channels, by BLAS.
+
+    With weights p_k = exp(a0_ik + b0_kj - c0_ij) of the log-matmul c0,
+    the entropy channel is c0 + sum_k p_k (a1 - a0 + b1 - b0), which is
+    three matmuls of the shifted exponentials (see :class:`_LogMatmul`).
+    Underflowed cells are recomputed or set to zero as there.
+    """
+
+    @staticmethod
+    def forward(ctx, a, b):
+        ma, mb, ea, eb = _LogMatmul._shift(a[0], b[0])
+        at, bt = a[1] - a[0], b[1] - b[0]
+        s = torch.matmul(ea, eb)
+        c = s.log() + ma + mb
+        h = (torch.matmul(ea * at, eb) + torch.matmul(ea, eb * bt)) / s
+        under, dead = _LogMatmul._cells(a[0], b[0], s)
+        c.masked_fill_(dead, _BaseLog.zero)
+        h.masked_fill_(dead, 0)
+        if under.any():
+            _, _, terms = _LogMatmul._underflow(a[0], b[0], under)
+            _, _, t = _LogMatmul._underflow(at, bt, under)
+            c[under] = torch.logsumexp(terms, dim=-1)
+            h[under] = (terms.softmax(-1) * t).sum(-1)
+        out = torch.stack((c, h + c))
+        ctx.save_for_backward(a, b, out, under, dead)
+        return out
+
+    @staticmethod
+    def backward(ctx, grad_output):
+        a, b, out, under, dead = ctx.saved_tensors
+        ma, mb, ea, eb = _LogMatmul._shift(a[0], b[0])
+        at, bt = a[1] - a[0], b[1] - b[0]
+        c, h = out[0], out[1] - out[0]
+        g0, g1 = grad_output[0], grad_output[1]
+
+        # d c / d a0 = p, d (h + c) / d a0 = p (t - h), d (h + c) / d a1 = p,
+        # with t = a1 - a0 + b1 - b0 and p = ea eb / s.
+        inv = (ma + mb - c).exp().masked_fill(under | dead, 0)
+        u, v = (g0 - g1 * h) * inv, g1 * inv
+        ebt, eat = eb.transpose(-2, -1), ea.transpose(-2, -1)
+        v_b = torch.matmul(v, ebt)
+        v_a = torch.matmul(eat, v)
+        grad_a = torch.stack(
+            (
+                ea
+                * (
+                    torch.matmul(u, ebt)
+                    + at * v_b
+                    + torch.matmul(v, (eb * bt).transpose(-2, -1))
+                ),
+                ea * v_b,
+            )
+        )
+        grad_b = torch.stack(
+            (
+                eb
+                * (
+                    torch.matmul(eat, u)
+                    + torch.matmul((ea * at).transpose(-2, -1), v)
+                    + bt * v_a
+                ),
+                eb * v_a,
+            )
+        )
+        if under.any():
+            rows, cols, terms = _LogMatmul._underflow(a[0], b[0], under)
+            _, _, t = _LogMatmul._underflow(at, bt, under)
+            p = terms.softmax(-1)
+            g0u, g1u = g0[under].unsqueeze(-1), g1[under].unsqueeze(-1)
+            p0 = p * (g0u + g1u * (t - h[under].unsqueeze(-1)))
+            p1 = p * g1u
+            size = (2,) + under.shape[:-2]
+            grad_a = grad_a.expand(size + grad_a.shape[-2:]).clone()
+            grad_b = grad_b.expand(size + grad_b.shape[-2:]).clone()
+            for ch, q in enumerate((p0, p1)):
+                grad_a[ch].index_put_(rows, q, accumulate=True)
+                grad_b[ch].transpose(-2, -1).index_put_(cols, q, accumulate=True)
+        return grad_a.sum_to_size(a.shape), grad_b.sum_to_size(b.shape)
+
+
+class _MaxMatmul(torch.autograd.Function):
+    """
+    Max-plus matmul `max(a[..., :, :, None] + b[..., None, :, :], -2)` over
+    blocks of k, keeping a running max and argmax. Blocks hold about
+    `block_cells` cells, so memory stays at the output size. The backward
+    scatters the gradient to the argmax of each cell.
+    """
+
+    block_cells = 2**22
+
+    @staticmethod
+    def forward(ctx, a, b):
+        k = a.shape[-1]
+        size = matmul_size(a, b)
+        c = a.new_full(size, -float("inf"))
+        arg = torch.zeros(size, dtype=torch.long, device=a.device)
+        block = max(1, min(k, _MaxMatmul.block_cells // max(c.numel(), 1)))
+        for start in range(0, k, block):
+            end = min(start + block, k)
+            t = a[..., start:end, None] + b[..., None, start:end, :]
+            m, i = t.max(-2)
+            better = m > c
+            c = torch.where(better, m, c)
+            arg = torch.where(better, i + start, arg)
+        ctx.save_for_backward(arg)
+        ctx.shapes = a.shape, b.shape
+        return c
+
+    @staticmethod
+    def backward(ctx, grad_output):
+        (arg,) = ctx.saved_tensors
+        a_shape, b_shape = ctx.shapes
+        size = arg.shape[:-2]
+        grad_a = grad_output.new_zeros(size + a_shape[-2:])
+        grad_b = grad_output.new_zeros(size + b_shape[-2:])
+        grad_a.scatter_add_(-1, arg, grad_output)
+        grad_b.scatter_add_(-2, arg, grad_output)
+        return grad_a.sum_to_size(a_shape), grad_b.sum_to_size(b_shape)
+
+
 class Semiring:
     """
     Base semiring class.
@@ -64,6 +268,11 @@ class Semiring:
         "Unconvert from semiring by removing extra first dimension."
         return potentials.squeeze(0)
 
+    @staticmethod
+    def marginals(potentials, grad):
+        "Marginals, as converted values, from the gradient of *potentials*."
+        return grad
+
     @staticmethod
     def zero_(xs):
         "Fill *ssize x ...* tensor with additive identity."
@@ -88,6 +297,23 @@ class Semiring:
     def plus(cls, a, b):
         return cls.sum(torch.stack([a, b], dim=-1))
 
+    @classmethod
+    def scatter_sum(cls, xs, index, size):
+        """
+        Sum the last dim of *ssize x ... x n* tensor into `size` slots, the
+        entry i into slot `index[i]`. Classes may override.
+
+        Slots are padded to their largest count and summed with `sum`.
+        """
+        counts = torch.bincount(index, minlength=size)
+        order = torch.argsort(index)
+        slot = torch.arange(len(index), device=index.device)
+        slot = slot - (counts.cumsum(0) - counts)[index[order]]
+        out = xs.new_empty(xs.shape[:-1] + (size, max(int(counts.max()), 1)))
+        out = cls.zero_(out)
+        out[..., index[order], slot] = xs[..., order]
+        return cls.sum(out)
+
 
 class _Base(Semiring):
     zero = 0
@@ -154,7 +380,7 @@ class StdSemiring(_Base):
         (Faster than calling sum and times.)
         """
 
-        if has_genbmm and isinstance(a, genbmm.BandedMatrix):
+        if is_banded(a):
             return b.multiply(a.transpose())
         else:
             return torch.matmul(a, b)
@@ -169,10 +395,147 @@ class LogSemiring(_BaseLog):
 
     @classmethod
     def matmul(cls, a, b):
-        if has_genbmm and isinstance(a, genbmm.BandedMatrix):
+        if is_banded(a):
             return b.multiply_log(a.transpose())
         else:
-            return _BaseLog.matmul(a, b)
+            return _LogMatmul.apply(a, b)
+
+    @classmethod
+    def scatter_sum(cls, xs, index, size):
+        "Scatter logsumexp, shifted by the max of each slot."
+        shape = xs.shape[:-1] + (size,)
+        index = index.expand_as(xs)
+        m = xs.new_full(shape, cls.zero).scatter_reduce(-1, index, xs.detach(), "amax")
+        s = xs.new_zeros(shape).scatter_add(-1, index, (xs - m.gather(-1, index)).exp())
+        # Empty slots are semiring zero.
+        return (s + (s == 0)).log() + m
+
+
+class ScaledSemiring(Semiring):
+    """
+    Implements the log semiring in probability space, as in the scaled
+    forward algorithm of HMMs.
+
+    Values are kept as a probability `v` and a log scale `s`, with log value
+    `log v + s`. Each matrix of a batch shares one scale. Matmuls multiply
+    by `StdSemiring.matmul` and renormalize each matrix by its maximum, so
+    a chain of matmuls, as in the scans of :class:`LinearChain` and
+    :class:`SemiMarkov`, runs without exp or log. Cells out of the range
+    of their matrix fall back to log space and keep their own scale, so
+    values and marginals match :class:`LogSemiring`.
+    """
+
+    @staticmethod
+    def size():
+        return 2
+
+    @classmethod
+    def convert(cls, xs):
+        dead = xs <= _BaseLog.zero
+        l = xs.masked_fill(dead, _BaseLog.zero)
+        s = l.detach().amax((-2, -1), keepdim=True).expand_as(l)
+        # Values too far below the scale of their matrix keep their own.
+        own = (l.detach() - s < math.log(torch.finfo(l.dtype).tiny)) & ~dead
+        s = torch.where(own, l.detach(), s)
+        v = (l - s).exp().masked_fill(dead, 0)
+        return torch.stack((v, s))
+
+    @staticmethod
+    def unconvert(xs):
+        dead = xs[0] == 0
+        return (xs[0].masked_fill(dead, 1).log() + xs[1]).masked_fill(
+            dead, _BaseLog.zero
+        )
+
+    @staticmethod
+    def _fix(v, s, under, exact):
+        "Replace the *under* cells by their exact log values."
+        if under.any():
+            l = exact()
+            v = torch.where(under, (l - l.detach()).exp(), v)
+            s = torch.where(under, l.detach(), s)
+        return torch.stack((v, s))
+
+    @staticmethod
+    def _align(v, s):
+        "Rescale the matrices of *v* from scales *s* to their largest scale."
+        r = s.amax((-2, -1), keepdim=True)
+        if (s == r).all():
+            return v, r
+        return v * (s - r).exp(), r
+
+    @classmethod
+    def sum(cls, xs, dim=-1):
+        assert dim != 0
+        d = dim - 1 if dim > 0 else dim
+        s = xs[1].detach()
+        # Zeros get no gradient, as in log space.
+        r = s.amax(d, keepdim=True)
+        r = r.masked_fill(r <= _BaseLog.zero, 0)
+        v = (xs[0] * (s - r).exp()).sum(d)
+        under = (v < torch.finfo(v.dtype).tiny) & (xs[0] > 0).any(d)
+        return cls._fix(
+            v,
+            r.squeeze(d).masked_fill(v == 0, _BaseLog.zero),
+            under,
+            lambda: torch.logsumexp(cls.unconvert(xs), dim=d),
+        )
+
+    @classmethod
+    def mul(cls, a, b):
+        v = a[0] * b[0]
+        under = (v < torch.finfo(v.dtype).tiny) & (a[0] > 0) & (b[0] > 0)
+        return cls._fix(
+            v,
+            (a[1].detach() + b[1].detach()).masked_fill(v == 0, _BaseLog.zero),
+            under,
+            lambda: cls.unconvert(a) + cls.unconvert(b),
+        )
+
+    @classmethod
+    def matmul(cls, a, b):
+        va, ra = cls._align(a[0], a[1].detach())
+        vb, rb = cls._align(b[0], b[1].detach())
+        c = StdSemiring.matmul(va, vb)
+        m = c.detach().amax((-2, -1), keepdim=True)
+        m = m.masked_fill(m == 0, 1)
+        under = c < torch.finfo(c.dtype).tiny
+        if under.any():
+            live = torch.matmul((a[0] > 0).to(c.dtype), (b[0] > 0).to(c.dtype))
+            under = under & (live > 0)
+
+        def exact():
+            la, lb = cls.unconvert(a), cls.unconvert(b)
+            _, _, terms = _LogMatmul._underflow(la, lb, under)
+            return torch.zeros_like(c).masked_scatter(
+                under, torch.logsumexp(terms, dim=-1)
+            )
+
+        # Zeros keep the scale of their matrix, which stays shared.
+        return cls._fix(c / m, (ra + rb + m.log()).expand_as(c), under, exact)
+
+    @staticmethod
+    def marginals(potentials, grad):
+        # Gradients are taken through v, and d / dx = v d / dv.
+        m = potentials[0] * grad[0]
+        return torch.stack((torch.ones_like(m), m))
+
+    @staticmethod
+    def zero_(xs):
+        xs[0].fill_(0)
+        xs[1].fill_(_BaseLog.zero)
+        return xs
+
+    @classmethod
+    def zero_mask_(cls, xs, mask):
+        xs[0].masked_fill_(mask, 0)
+        xs[1].masked_fill_(mask, _BaseLog.zero)
+
+    @staticmethod
+    def one_(xs):
+        xs[0].fill_(1)
+        xs[1].fill_(0)
+        return xs
 
 
 class MaxSemiring(_BaseLog):
@@ -184,26 +547,56 @@ class MaxSemiring(_BaseLog):
 
     @classmethod
     def matmul(cls, a, b):
-        if has_genbmm and isinstance(a, genbmm.BandedMatrix):
+        if is_banded(a):
             return b.multiply_max(a.transpose())
         else:
-            return matmul(cls, a, b)
+            return _MaxMatmul.apply(a, b)
 
     @staticmethod
     def sum(xs, dim=-1):
         return torch.max(xs, dim=dim)[0]
 
+    @classmethod
+    def scatter_sum(cls, xs, index, size):
+        "Scatter max, read from the first argmax of each slot."
+        shape = xs.shape[:-1] + (size,)
+        n = xs.shape[-1]
+        index = index.expand_as(xs)
+        m = xs.new_full(shape, -float("inf"))
+        m = m.scatter_reduce(-1, index, xs.detach(), "amax", include_self=False)
+        pos = torch.arange(n, device=xs.device).expand_as(xs)
+        pos = pos.masked_fill(xs.detach() < m.gather(-1, index), n)
+        arg = pos.new_full(shape, n).scatter_reduce(-1, index, pos, "amin")
+        # Empty slots read an extra semiring zero.
+        xs = torch.cat([xs, xs.new_full(xs.shape[:-1] + (1,), cls.zero)], -1)
+        return xs.gather(-1, arg)
+
     @staticmethod
     def sparse_sum(xs, dim=-1):
         m, a = torch.max(xs, dim=dim)
         return m, (torch.zeros(a.shape).long(), a)
 
 
+@functools.lru_cache(maxsize=64)
+def _kmax_frontier(k, device):
+    """
+    Slot pairs (i, j) with (i + 1)(j + 1) <= k. For two lists sorted in
+    decreasing order, the other pairs are each dominated by k pairs, so
+    only these O(k log k) sums can be among the k largest.
+    """
+    pairs = [(i, j) for i in range(k) for j in range(k // (i + 1))]
+    i, j = zip(*pairs)
+    return torch.tensor(i, device=device), torch.tensor(j, device=device)
+
+
 def KMaxSemiring(k):
     """
     Implements the k-max semiring (kmax, +, [-inf, -inf..], [0, -inf, ...]).
 
     Gradients give k-argmax.
+
+    Slots are kept sorted in decreasing order, which `mul` uses to only
+    sum the O(k log k) slot pairs that can be among the k best.
     """
 
     class KMaxSemiring(_BaseLog):
@@ -213,15 +606,16 @@ def KMaxSemiring(k):
 
         @classmethod
         def convert(cls, orig_potentials):
-            potentials = torch.zeros(
-                (k,) + orig_potentials.shape,
-                dtype=orig_potentials.dtype,
-                device=orig_potentials.device,
+            potentials = orig_potentials.new_full(
+                (k,) + orig_potentials.shape, cls.zero
             )
-            cls.zero_(potentials)
             potentials[0] = orig_potentials
             return potentials
 
+        @classmethod
+        def zero_(cls, xs):
+            return xs.fill_(cls.zero)
+
         @classmethod
         def one_(cls, xs):
             cls.zero_(xs)
@@ -235,12 +629,8 @@ def KMaxSemiring(k):
         @staticmethod
         def sum(xs, dim=-1):
             if dim == -1:
-                xs = xs.permute(tuple(range(1, xs.dim())) + (0,))
-                xs = xs.contiguous().view(xs.shape[:-2] + (-1,))
-                xs = torch.topk(xs, k, dim=-1)[0]
-                xs = xs.permute((xs.dim() - 1,) + tuple(range(0, xs.dim() - 1)))
-                assert xs.shape[0] == k
-                return xs
+                xs = xs.movedim(0, -1).flatten(-2)
+                return torch.topk(xs, k, dim=-1)[0].movedim(-1, 0)
             assert False
 
         @staticmethod
@@ -257,13 +647,8 @@ def KMaxSemiring(k):
 
         @staticmethod
         def mul(a, b):
-            a = a.view((k, 1) + a.shape[1:])
-            b = b.view((1, k) + b.shape[1:])
-            c = a + b
-            c = c.contiguous().view((k * k,) + c.shape[2:])
-            ret = torch.topk(c, k, 0)[0]
-            assert ret.shape[0] == k
-            return ret
+            i, j = _kmax_frontier(k, a.device)
+            return torch.topk(a[i] + b[j], k, 0)[0]
 
     return KMaxSemiring
 
@@ -288,10 +673,7 @@ class EntropySemiring(Semiring):
 
     @staticmethod
     def convert(xs):
-        values = torch.zeros((2,) + xs.shape).type_as(xs)
-        values[0] = xs
-        values[1] = 0
-        return values
+        return torch.stack((xs, torch.zeros_like(xs)))
 
     @staticmethod
     def unconvert(xs):
@@ -302,13 +684,17 @@ class EntropySemiring(Semiring):
         assert dim != 0
         d = dim - 1 if dim > 0 else dim
         part = torch.logsumexp(xs[0], dim=d)
-        log_sm = xs[0] - part.unsqueeze(d)
-        sm = log_sm.exp()
-        return torch.stack((part, torch.sum(xs[1].mul(sm) - log_sm.mul(sm), dim=d)))
+        sm = torch.softmax(xs[0], dim=d)
+        return torch.stack((part, part + torch.sum(sm * (xs[1] - xs[0]), dim=d)))
 
     @staticmethod
     def mul(a, b):
-        return torch.stack((a[0] + b[0], a[1] + b[1]))
+        return a + b
+
+    @classmethod
+    def matmul(cls, a, b):
+        "Fused matmul of both channels (see :class:`_EntropyMatmul`)."
+        return _EntropyMatmul.apply(a, b)
 
     @classmethod
     def prod(cls, xs, dim=-1):
@@ -317,7 +703,7 @@ class EntropySemiring(Semiring):
     @classmethod
     def zero_mask_(cls, xs, mask):
         "Fill *ssize x ...* tensor with additive identity."
-        xs[0].masked_fill_(mask, -1e5)
+        xs[0].masked_fill_(mask, _BaseLog.zero)
         xs[1].masked_fill_(mask, 0)
 
     @staticmethod
@@ -1,5 +1,6 @@
 import torch
 from .semirings import _BaseLog
+from .checkpoint import matmul_size
 
 
 class SparseMaxSemiring(_BaseLog):
@@ -17,12 +18,17 @@ class SparseMaxSemiring(_BaseLog):
     def sum(xs, dim=-1):
         return _SimplexProject.apply(xs, dim)
 
+    @classmethod
+    def matmul(cls, a, b):
+        "Sparsemax over k of `a[..., :, :, None] + b[..., None, :, :]` in row blocks."
+        return _SparseMaxMatmul.apply(a, b)
+
 
 class _SimplexProject(torch.autograd.Function):
     @staticmethod
     def forward(ctx, input, dim, z=1):
         w_star = project_simplex(input, dim)
-        ctx.save_for_backward(input, w_star.clone(), torch.tensor(dim))
+        ctx.save_for_backward(input, w_star, torch.tensor(dim))
         x = input.mul(w_star).sum(dim) - w_star.norm(p=2, dim=dim)
         return x
 
@@ -50,22 +56,83 @@ class _SparseMaxGrad(torch.autograd.Function):
         return sparsemax_grad(grad_output, w_star, dim.item()), None
 
 
+class _SparseMaxMatmul(torch.autograd.Function):
+    """
+    Sparsemax semiring matmul over blocks of rows of `a`. Blocks hold about
+    `block_cells` cells of the *n x k x m* scores. Only the thresholds of
+    the output cells are saved, and backward recomputes the projections of
+    each block from them.
+    """
+
+    block_cells = 2**22
+
+    @staticmethod
+    def _blocks(a, b):
+        n, k, m = a.shape[-2], a.shape[-1], b.shape[-1]
+        size = matmul_size(a, b)
+        block = _SparseMaxMatmul.block_cells // max(size[:-2].numel() * k * m, 1)
+        block = max(1, min(n, block))
+        return size, [slice(r, r + block) for r in range(0, n, block)]
+
+    @staticmethod
+    def forward(ctx, a, b):
+        size, blocks = _SparseMaxMatmul._blocks(a, b)
+        c = a.new_empty(size)
+        tau = a.new_empty(size)
+        for r in blocks:
+            t = a[..., r, :, None] + b[..., None, :, :]
+            tau_r = simplex_threshold(t, -2)
+            w = torch.clamp(t - tau_r, min=0)
+            c[..., r, :] = t.mul(w).sum(-2) - w.norm(p=2, dim=-2)
+            tau[..., r, :] = tau_r.squeeze(-2)
+        ctx.save_for_backward(a, b, tau)
+        return c
+
+    @staticmethod
+    def backward(ctx, grad_output):
+        a, b, tau = ctx.saved_tensors
+        size, blocks = _SparseMaxMatmul._blocks(a, b)
+        grad_a = a.new_zeros(size[:-2] + a.shape[-2:])
+        grad_b = b.new_zeros(size[:-2] + b.shape[-2:])
+        for r in blocks:
+            t = a[..., r, :, None] + b[..., None, :, :]
+            w = torch.clamp(t - tau[..., r, None, :], min=0)
+            gw = grad_output[..., r, None, :] * w
+            grad_a[..., r, :] += gw.sum(-1)
+            grad_b += gw.sum(-3)
+        return grad_a.sum_to_size(a.shape), grad_b.sum_to_size(b.shape)
+
+
+def simplex_threshold(v, dim, z=1):
+    """
+    Threshold tau of the projection `max(v - tau, 0)` of v onto the simplex
+    along `dim`, kept as a size 1 dim.
+
+    The support is found among the top-k values, with k grown until every
+    support is smaller than k, so small supports cost one partial sort.
+    """
+    n = v.shape[dim]
+    shape = [1] * v.dim()
+    shape[dim] = -1
+    k = min(n, 8)
+    while True:
+        top = torch.topk(v, k, dim=dim)[0]
+        cssv = torch.cumsum(top, dim=dim) - z
+        ind = torch.arange(1, 1 + k, device=v.device, dtype=v.dtype).view(shape)
+        supp = (top - cssv / ind > 0).sum(dim=dim, keepdim=True)
+        if k == n or (supp < k).all():
+            break
+        k = min(n, 4 * k)
+    supp = supp.clamp(min=1)
+    return cssv.gather(dim, supp - 1) / supp.to(dtype=v.dtype)
+
+
 def project_simplex(v, dim, z=1):
-    v_sorted, _ = torch.sort(v, dim=dim, descending=True)
-    cssv = torch.cumsum(v_sorted, dim=dim) - z
-    ind = torch.arange(1, 1 + v.shape[dim]).to(dtype=v.dtype)
-    cond = v_sorted - cssv / ind >= 0
-    k = cond.sum(dim=dim, keepdim=True)
-    tau = cssv.gather(dim, k - 1) / k.to(dtype=v.dtype)
-    w = torch.clamp(v - tau, min=0)
-    return w
+    return torch.clamp(v - simplex_threshold(v, dim, z), min=0)
 
 
 def sparsemax_grad(dout, w_star, dim):
-    out = dout.clone()
     supp = w_star > 0
-    out[w_star <= 0] = 0
-    nnz = supp.to(dtype=dout.dtype).sum(dim=dim, keepdim=True)
-    out = out - (out.sum(dim=dim, keepdim=True) / nnz)
-    out[w_star <= 0] = 0
-    return out
+    out = dout.masked_fill(~supp, 0)
+    nnz = supp.sum(dim=dim, keepdim=True).to(dtype=dout.dtype)
+    return (out - out.sum(dim=dim, keepdim=True) / nnz).masked_fill(~supp, 0)
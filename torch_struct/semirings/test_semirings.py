@@ -1,6 +1,6 @@
 import torch
-from hypothesis import given
-from hypothesis.strategies import integers
+from hypothesis import given, settings
+from hypothesis.strategies import integers, sampled_from
 
 
 from . import (
@@ -10,7 +10,12 @@ from . import (
     KMaxSemiring,
     MaxSemiring,
     StdSemiring,
+    BandedMatrix,
+    EntropySemiring,
+    ScaledSemiring,
 )
+from .semirings import Semiring, matmul, _MaxMatmul
+from .sparse_max import SparseMaxSemiring, _SparseMaxMatmul, project_simplex
 
 
 lint = integers(min_value=2, max_value=10)
@@ -40,6 +45,22 @@ def test_max(a, b, c):
     assert torch.isclose(b, b2[0]).all()
 
 
+@given(integers(1, 8), lint)
+def test_kmax_mul(k, a):
+    torch.manual_seed(0)
+    t1 = torch.rand(k, a).sort(0, descending=True)[0].requires_grad_(True)
+    t2 = torch.rand(k, a).sort(0, descending=True)[0].requires_grad_(True)
+    r1 = KMaxSemiring(k).mul(t1, t2)
+    r2 = torch.topk((t1[:, None] + t2[None]).view(k * k, a), k, 0)[0]
+    assert torch.isclose(r1, r2).all()
+
+    (a1, b1) = torch.autograd.grad(r1[0].sum(), (t1, t2))
+    (a2, b2) = torch.autograd.grad(r2[0].sum(), (t1, t2))
+    assert torch.isclose(a1, a2).all()
+    assert torch.isclose(b1, b2).all()
+
+
+@settings(deadline=None)
 @given(lint, lint, lint)
 def test_checkpoint(a, b, c):
     torch.manual_seed(0)
@@ -58,6 +79,28 @@ def test_checkpoint(a, b, c):
     assert torch.isclose(b1, b2).all()
 
 
+@settings(deadline=None)
+@given(lint, lint, lint, integers(1, 200))
+def test_checkpoint_shard(a, b, c, max_size):
+    torch.manual_seed(0)
+    t1 = torch.rand(a, 1, 3, c).requires_grad_(True)
+    t2 = torch.rand(1, b, c, 2).requires_grad_(True)
+
+    r1 = LogSemiring.matmul(t1, t2)
+    (a1, b1) = torch.autograd.grad(r1.sum(), (t1, t2))
+    for semiring in [
+        CheckpointShardSemiring(LogSemiring, max_size),
+        CheckpointShardSemiring(LogSemiring, shard_budget=max_size),
+        CheckpointShardSemiring(LogSemiring),
+    ]:
+        r2 = semiring.matmul(t1, t2)
+        assert torch.isclose(r1, r2).all()
+
+        (a2, b2) = torch.autograd.grad(r2.sum(), (t1, t2))
+        assert torch.isclose(a1, a2).all()
+        assert torch.isclose(b1, b2).all()
+
+
 @given(lint, lint, lint, lint)
 def test_matmul(a, b, c, d):
     torch.manual_seed(0)
@@ -79,3 +122,228 @@ def test_matmul(a, b, c, d):
 
     # assert torch.isclose(a1, a2).all()
     # assert torch.isclose(b1, b2).all()
+
+
+@given(lint, lint, lint, lint, sampled_from([0, -1000, -20000]))
+def test_log_matmul(a, b, c, d, underflow):
+    torch.manual_seed(0)
+    t1 = torch.rand(a, b, c, dtype=torch.double)
+    t2 = torch.rand(1, c, d, dtype=torch.double)
+    if underflow:
+        # The terms of the first row are all about `underflow`, below
+        # float64 range, but not semiring zeros.
+        t1[:, 0, 1:] = underflow
+        t2[:, 0, :] = underflow
+    t1.requires_grad_(True)
+    t2.requires_grad_(True)
+
+    r1 = LogSemiring.matmul(t1, t2)
+    r2 = matmul(LogSemiring, t1, t2)
+    assert torch.isclose(r1, r2, atol=1e-5).all()
+
+    (a1, b1) = torch.autograd.grad(r1.sum(), (t1, t2))
+    (a2, b2) = torch.autograd.grad(r2.sum(), (t1, t2))
+    assert torch.isclose(a1, a2, atol=1e-5).all()
+    assert torch.isclose(b1, b2, atol=1e-5).all()
+
+    # Second order gradients, as for gradients of marginals.
+    g = []
+    for r in (LogSemiring.matmul(t1, t2), matmul(LogSemiring, t1, t2)):
+        (a1, b1) = torch.autograd.grad(r.sum(), (t1, t2), create_graph=True)
+        g.append(torch.autograd.grad(a1.pow(2).sum() + b1.pow(2).sum(), (t1, t2)))
+    for x, y in zip(*g):
+        assert torch.isclose(x, y, rtol=1e-3, atol=1e-3).all()
+
+    t1 = torch.tensor([[-20000.0, -20100.0]])
+    t2 = torch.tensor([[-200.0], [0.0]])
+    assert LogSemiring.matmul(t1, t2).item() == -20100.0
+
+
+@given(lint, lint, lint, lint, sampled_from([0, -1000]))
+def test_scaled_matmul(a, b, c, d, underflow):
+    torch.manual_seed(0)
+    t1 = torch.rand(a, b, c, dtype=torch.double) * 10
+    t2 = torch.rand(1, c, d, dtype=torch.double) * 10
+    if underflow:
+        # The first row of the scaled product underflows.
+        t1[:, 0, 1:] = underflow
+        t2[:, 0, :] = underflow
+    t1.requires_grad_(True)
+    t2.requires_grad_(True)
+
+    x = ScaledSemiring.matmul(ScaledSemiring.convert(t1), ScaledSemiring.convert(t2))
+    # Renormalized products chain without leaving probability space.
+    x = ScaledSemiring.matmul(x, ScaledSemiring.convert(t2.transpose(-2, -1)))
+    r1 = ScaledSemiring.unconvert(x)
+    r2 = LogSemiring.matmul(LogSemiring.matmul(t1, t2), t2.transpose(-2, -1))
+    assert torch.isclose(r1, r2, atol=1e-5).all()
+
+    (a1, b1) = torch.autograd.grad(r1.sum(), (t1, t2))
+    (a2, b2) = torch.autograd.grad(r2.sum(), (t1, t2))
+    assert torch.isclose(a1, a2, atol=1e-5).all()
+    assert torch.isclose(b1, b2, atol=1e-5).all()
+
+
+@given(lint, lint, lint, lint, sampled_from([False, True]))
+def test_entropy_matmul(a, b, c, d, underflow):
+    torch.manual_seed(0)
+    t1 = torch.rand(2, a, b, c)
+    t2 = torch.rand(2, 1, c, d)
+    if underflow:
+        t1[0, :, 0, 1:] = -500
+        t2[0, :, 0, :] = -500
+    t1.requires_grad_(True)
+    t2.requires_grad_(True)
+
+    r1 = EntropySemiring.matmul(t1, t2)
+    r2 = matmul(EntropySemiring, t1, t2)
+    assert torch.isclose(r1, r2, atol=1e-4).all()
+
+    g = torch.rand(r1.shape)
+    (a1, b1) = torch.autograd.grad(r1, (t1, t2), g)
+    (a2, b2) = torch.autograd.grad(r2, (t1, t2), g)
+    assert torch.isclose(a1, a2, atol=1e-4).all()
+    assert torch.isclose(b1, b2, atol=1e-4).all()
+
+
+@given(lint, lint, lint, lint, integers(1, 4))
+def test_sparse_max_matmul(a, b, c, d, block):
+    torch.manual_seed(0)
+    t1 = (3 * torch.rand(a, b, c)).requires_grad_(True)
+    t2 = (3 * torch.rand(1, c, d)).requires_grad_(True)
+
+    # Project rows of t1 in blocks of `block` rows.
+    cells = _SparseMaxMatmul.block_cells
+    _SparseMaxMatmul.block_cells = block * a * c * d
+    r1 = SparseMaxSemiring.matmul(t1, t2)
+    _SparseMaxMatmul.block_cells = cells
+    r2 = matmul(SparseMaxSemiring, t1, t2)
+    assert torch.isclose(r1, r2, atol=1e-5).all()
+
+    g = torch.rand(r1.shape)
+    (a1, b1) = torch.autograd.grad(r1, (t1, t2), g)
+    (a2, b2) = torch.autograd.grad(r2, (t1, t2), g)
+    assert torch.isclose(a1, a2, atol=1e-5).all()
+    assert torch.isclose(b1, b2, atol=1e-5).all()
+
+
+@given(lint, integers(1, 40))
+def test_project_simplex(a, n):
+    torch.manual_seed(0)
+    v = 3 * torch.randn(a, n)
+    w = project_simplex(v, -1)
+    assert torch.isclose(w.sum(-1), torch.tensor(1.0)).all()
+    assert (w >= 0).all()
+
+    # Reference: full sort.
+    v_sorted = v.sort(-1, descending=True)[0]
+    cssv = v_sorted.cumsum(-1) - 1
+    k = (v_sorted - cssv / torch.arange(1, n + 1) > 0).sum(-1, keepdim=True)
+    tau = cssv.gather(-1, k - 1) / k
+    assert torch.isclose(w, torch.clamp(v - tau, min=0)).all()
+
+
+@given(lint, lint, lint, lint, integers(1, 4))
+def test_max_matmul(a, b, c, d, block):
+    torch.manual_seed(0)
+    t1 = torch.rand(a, b, c).requires_grad_(True)
+    t2 = torch.rand(1, c, d).requires_grad_(True)
+
+    # Tile k into blocks of `block` columns.
+    cells = _MaxMatmul.block_cells
+    _MaxMatmul.block_cells = block * a * b * d
+    r1 = MaxSemiring.matmul(t1, t2)
+    _MaxMatmul.block_cells = cells
+    r2 = matmul(MaxSemiring, t1, t2)
+    assert torch.isclose(r1, r2).all()
+
+    (a1, b1) = torch.autograd.grad(r1.sum(), (t1, t2))
+    (a2, b2) = torch.autograd.grad(r2.sum(), (t1, t2))
+    assert torch.isclose(a1, a2).all()
+    assert torch.isclose(b1, b2).all()
+
+
+@given(lint, integers(0, 3), integers(0, 3), integers(0, 3), integers(0, 3))
+def test_banded(n, a_lu, a_ld, b_lu, b_ld):
+    torch.manual_seed(0)
+    for semiring in (StdSemiring, LogSemiring, MaxSemiring):
+        zero = semiring.zero
+        a = BandedMatrix(torch.rand(2, n, a_lu + a_ld + 1), a_lu, a_ld, zero)
+        b = BandedMatrix(torch.rand(2, n, b_lu + b_ld + 1), b_lu, b_ld, zero)
+        A, B = a.to_dense(), b.to_dense()
+        assert torch.isclose(
+            BandedMatrix.from_dense(A, a_lu, a_ld, zero).to_dense(), A
+        ).all()
+        assert (a.transpose().to_dense() == A.transpose(-2, -1)).all()
+
+        # Banded semiring matmul(a, b) is the dense product b @ a.
+        c = semiring.matmul(a, b)
+        assert (c.lu, c.ld) == (a_lu + b_lu, a_ld + b_ld)
+        assert torch.isclose(c.to_dense(), semiring.matmul(B, A)).all()
+
+        # Gradients of the cells inside the matrix.
+        t1, t2 = a.data.requires_grad_(True), b.data.requires_grad_(True)
+        r1 = semiring.matmul(a, b)
+        r2 = semiring.matmul(b.to_dense(), a.to_dense())
+        g = BandedMatrix(torch.rand(r1.data.shape), r1.lu, r1.ld)._masked()
+        (a1, b1) = torch.autograd.grad(r1.data, (t1, t2), g)
+        g = BandedMatrix(g, r1.lu, r1.ld).to_dense()
+        (a2, b2) = torch.autograd.grad(r2, (t1, t2), g)
+        assert torch.isclose(a1, a2, atol=1e-5).all()
+        assert torch.isclose(b1, b2, atol=1e-5).all()
+
+
+@settings(deadline=None)
+@given(sampled_from([StdSemiring, LogSemiring, MaxSemiring]))
+def test_banded_memory(semiring):
+    # The band product allocates O(n x out.width), not the
+    # n x out.width x width terms at once.
+    n, lu, ld = 64, 16, 16
+    t1 = torch.rand(2, n, lu + ld + 1).requires_grad_(True)
+    t2 = torch.rand(2, n, lu + ld + 1).requires_grad_(True)
+    with torch.profiler.profile(profile_memory=True) as prof:
+        a = BandedMatrix(t1, lu, ld, semiring.zero)
+        b = BandedMatrix(t2, ld, lu, semiring.zero)
+        c = semiring.matmul(a, b).data
+        c.sum().backward()
+    largest = max((e.cpu_memory_usage for e in prof.events()))
+    assert largest < 8 * c.numel() * c.element_size()
+
+
+@given(lint, integers(0, 3), integers(0, 3), sampled_from([LogSemiring, MaxSemiring]))
+def test_checkpoint_banded(n, lu, ld, semiring):
+    torch.manual_seed(0)
+    t1 = torch.rand(2, n, lu + ld + 1).requires_grad_(True)
+    t2 = torch.rand(2, n, ld + lu + 1).requires_grad_(True)
+    a = BandedMatrix(t1, lu, ld, semiring.zero)
+    b = BandedMatrix(t2, ld, lu, semiring.zero)
+
+    r1 = semiring.matmul(a, b).data
+    r2 = CheckpointSemiring(semiring).matmul(a, b).data
+    assert torch.isclose(r1, r2).all()
+
+    (a1, b1) = torch.autograd.grad(r1.sum(), (t1, t2))
+    (a2, b2) = torch.autograd.grad(r2.sum(), (t1, t2))
+    assert torch.isclose(a1, a2).all()
+    assert torch.isclose(b1, b2).all()
+
+
+@settings(deadline=None)
+@given(
+    lint,
+    integers(1, 20),
+    sampled_from([LogSemiring, MaxSemiring, KMaxSemiring(2), EntropySemiring]),
+)
+def test_scatter_sum(size, n, semiring):
+    torch.manual_seed(0)
+    index = torch.randint(size, (n,))
+    xs = semiring.convert(torch.rand(3, n)).requires_grad_(True)
+    r1 = semiring.scatter_sum(xs, index, size)
+    r2 = Semiring.scatter_sum.__func__(semiring, xs, index, size)
+    for a in index.unique():
+        assert torch.isclose(r1[..., a], r2[..., a], atol=1e-5).all()
+
+    g = torch.rand(r1.shape)
+    (a1,) = torch.autograd.grad(r1, (xs,), g)
+    (a2,) = torch.autograd.grad(r2, (xs,), g)
+    assert torch.isclose(a1, a2, atol=1e-5).all()
@@ -1,11 +1,14 @@
-from .cky import CKY
+from .cky import CKY, ExpectedCounts
 from .cky_crf import CKY_CRF
 from .deptree import DepTree, deptree_nonproj, deptree_part
 from .linearchain import LinearChain
 from .semimarkov import SemiMarkov
 from .alignment import Alignment
+from .ctc import CTC
+from .test_utils import ctc_targets
 from .semirings import (
     LogSemiring,
+    ScaledSemiring,
     CheckpointSemiring,
     CheckpointShardSemiring,
     KMaxSemiring,
@@ -97,12 +100,17 @@ def test_entropy(data):
 
 
 @given(data())
+@settings(deadline=None)
 def test_kmax(data):
     model = data.draw(sampled_from([LinearChain, SemiMarkov, DepTree]))
     K = 2
     semiring = KMaxSemiring(K)
     struct = model(semiring)
     vals, (batch, N) = model._rand()
+
+    # convert and zero_ fill the empty slots with the same zero.
+    x = semiring.convert(vals)
+    assert (semiring.zero_(x.clone())[1:] == x[1:]).all()
     max1 = model(MaxSemiring).sum(vals)
     alpha = struct.sum(vals, _raw=True)
     assert (alpha[0] == max1).all()
@@ -138,6 +146,409 @@ def test_cky(data):
     assert torch.isclose(count[0], alpha[0])
 
 
+@given(data())
+@settings(max_examples=50, deadline=None)
+def test_cky_rank(data):
+    semiring = data.draw(sampled_from([LogSemiring, MaxSemiring]))
+    R = data.draw(integers(min_value=1, max_value=4))
+    (terms, rules, roots), (batch, N) = CKY._rand()
+    NT, S = rules.shape[1], rules.shape[2]
+    factors = (
+        torch.rand(batch, NT, R),
+        torch.rand(batch, S, R),
+        torch.rand(batch, S, R),
+    )
+    factors = tuple((f.requires_grad_(True) for f in factors))
+    parent, left, right = factors
+    dense = semiring.sum(
+        parent[:, :, None, None] + left[:, None, :, None] + right[:, None, None, :]
+    )
+
+    alpha = CKY(semiring).sum((terms, factors, roots))
+    count = CKY(semiring).sum((terms, dense, roots))
+    assert torch.isclose(alpha, count).all()
+
+    marg = CKY(semiring).marginals((terms, factors, roots))
+    grads = torch.autograd.grad(count.sum(), factors)
+    dense_marg = CKY(semiring).marginals((terms, dense, roots))
+    pairs = list(zip(marg[1], grads)) + [(marg[i], dense_marg[i]) for i in (0, 2, 3)]
+    same = torch.stack(
+        [torch.isclose(m, g, atol=1e-5).flatten(1).all(1) for m, g in pairs]
+    ).all(0)
+    if semiring is MaxSemiring:
+        # Rank-R rules give trees with the same rule multiset, e.g. other
+        # bracketings, the same score up to rounding. Where the argmaxes
+        # differ, the factored best tree must be a best tree of the dense
+        # rules too.
+        keep = torch.zeros(batch, N, N, NT, dtype=torch.bool)
+        for w in range(1, N):
+            spans = marg[3][:, w - 1, : N - w].transpose(-2, -1) > 0
+            keep.diagonal(w, 1, 2).copy_(spans)
+        tied = CKY(semiring, keep=keep).sum((terms, dense, roots))
+        same = same | torch.isclose(tied, count)
+    assert same.all()
+
+
+@given(data(), integers(min_value=1, max_value=10))
+@settings(max_examples=50, deadline=None)
+def test_cky_outside(data, seed):
+    semiring = data.draw(sampled_from([LogSemiring, MaxSemiring]))
+    torch.manual_seed(seed)
+    vals, (batch, N) = CKY._rand()
+    lengths = torch.tensor(
+        [data.draw(integers(min_value=2, max_value=N)) for b in range(batch - 1)] + [N]
+    )
+    vals = tuple((v.requires_grad_(True) for v in vals))
+    checkpoint = data.draw(integers(min_value=1, max_value=3))
+    marg = CKY(semiring, checkpoint).marginals(vals, lengths=lengths)
+    marg2 = CKY(semiring).marginals(vals, lengths=lengths, _autograd=True)
+    for m, m2 in zip(marg, marg2):
+        assert torch.isclose(m, m2, atol=1e-6).all()
+
+    if semiring is MaxSemiring:
+        return
+
+    # Gradients of the marginals are recomputed on demand.
+    grads = torch.autograd.grad(sum((m.pow(2).sum() for m in marg)), vals)
+    grads2 = torch.autograd.grad(sum((m.pow(2).sum() for m in marg2)), vals)
+    for g, g2 in zip(grads, grads2):
+        assert torch.isclose(g, g2, atol=1e-5).all()
+
+
+@given(data(), integers(min_value=1, max_value=10))
+@settings(max_examples=50, deadline=None)
+def test_chart_dp(data, seed):
+    model = data.draw(sampled_from([CKY_CRF, DepTree]))
+    checkpoint = data.draw(integers(min_value=0, max_value=3))
+    torch.manual_seed(seed)
+    vals, (batch, N) = model._rand()
+    vals.requires_grad_(True)
+    struct = model(LogSemiring, checkpoint)
+
+    # Marginals from the chart sweep match the brute force gradients.
+    marg = struct.marginals(vals)
+    enum = struct.enumerate(vals)[0]
+    (enum_marg,) = torch.autograd.grad(enum.sum(), vals, create_graph=True)
+    assert torch.isclose(marg, enum_marg, atol=1e-5).all()
+
+    # Second order gradients recompute the chart.
+    (g,) = torch.autograd.grad(marg.pow(2).sum(), vals)
+    (g2,) = torch.autograd.grad(enum_marg.pow(2).sum(), vals)
+    assert torch.isclose(g, g2, atol=1e-5).all()
+
+
+@given(data(), integers(min_value=1, max_value=10))
+@settings(max_examples=50, deadline=None)
+def test_scaled(data, seed):
+    model = data.draw(sampled_from([LinearChain, SemiMarkov, DepTree]))
+    torch.manual_seed(seed)
+    vals, (batch, N) = model._rand()
+    lengths = torch.tensor(
+        [data.draw(integers(min_value=2, max_value=N)) for b in range(batch - 1)] + [N]
+    )
+    vals = vals * data.draw(sampled_from([1, 100]))
+
+    # The scaled forward gives the log-space values and marginals.
+    s = model(LogSemiring).sum(vals, lengths)
+    s2 = model(ScaledSemiring).sum(vals, lengths)
+    assert torch.isclose(s, s2, atol=1e-5).all()
+    marg = model(LogSemiring).marginals(vals, lengths)
+    marg2 = model(ScaledSemiring).marginals(vals, lengths)
+    assert torch.isclose(marg, marg2, atol=1e-4).all()
+
+
+@given(data(), integers(min_value=1, max_value=10))
+@settings(max_examples=50, deadline=None)
+def test_max_width(data, seed):
+    torch.manual_seed(seed)
+    vals, (batch, N) = CKY_CRF._rand()
+    W = data.draw(integers(min_value=1, max_value=N))
+    vals.requires_grad_(True)
+    struct = CKY_CRF(LogSemiring, max_width=W)
+
+    # Spans wider than W must be prefixes [0, j).
+    i = torch.arange(N)
+    allowed = (i[None, :] - i[:, None] < W) | (i[:, None] == 0)
+    masked = vals.masked_fill(~allowed[None, :, :, None], -1e9)
+    alpha = struct.sum(vals)
+    count = CKY_CRF(LogSemiring).sum(masked)
+    assert torch.isclose(alpha, count).all()
+
+    marg = struct.marginals(vals)
+    marg2 = CKY_CRF(LogSemiring).marginals(masked)
+    assert torch.isclose(marg, marg2, atol=1e-5).all()
+
+
+@given(data(), integers(min_value=1, max_value=10))
+@settings(max_examples=50, deadline=None)
+def test_cky_max_width(data, seed):
+    torch.manual_seed(seed)
+    (terms, rules, roots), (batch, N) = CKY._rand()
+    W = data.draw(integers(min_value=1, max_value=N))
+    R = data.draw(integers(min_value=1, max_value=3))
+    NT, S = rules.shape[1], rules.shape[2]
+    factors = tuple((torch.rand(batch, n, R) for n in (NT, S, S)))
+    dense = CKY.rank_rules(*factors)
+    struct = CKY(LogSemiring, max_width=W)
+
+    alpha = struct.sum((terms, factors, roots))
+    count = struct.sum((terms, dense, roots))
+    assert torch.isclose(alpha, count).all()
+
+    # Spans wider than W must be prefixes [0, j), and only the W - 1
+    # bounded widths and the spine get span potentials.
+    marg = struct.marginals((terms, rules, roots))
+    assert (marg[3][:, W - 1 :, 1:] == 0).all()
+    span_pot = struct._dp((terms, rules, roots))[1][3]
+    assert span_pot.shape[2] == (W - 1) * N + N - W
+    if W == N:
+        marg2 = CKY(LogSemiring).marginals((terms, rules, roots))
+        for m, m2 in zip(marg, marg2):
+            assert torch.isclose(m, m2, atol=1e-5).all()
+
+
+@given(data(), integers(min_value=1, max_value=10))
+@settings(max_examples=50, deadline=None)
+def test_prune(data, seed):
+    torch.manual_seed(seed)
+    vals, (batch, N) = CKY_CRF._rand()
+    vals.requires_grad_(True)
+    W = data.draw(integers(min_value=1, max_value=N))
+    keep = CKY_CRF.prune(torch.rand(vals.shape), threshold=0.3, beam=2)
+    keep[:, 0] = True
+    struct = CKY_CRF(LogSemiring, max_width=W, keep=keep)
+
+    # Pruning matches semiring zero potentials on the pruned labels.
+    masked = vals.masked_fill(~keep, -1e9)
+    alpha = struct.sum(vals)
+    count = CKY_CRF(LogSemiring, max_width=W).sum(masked)
+    assert torch.isclose(alpha, count).all()
+    marg = struct.marginals(vals)
+    marg2 = CKY_CRF(LogSemiring, max_width=W).marginals(masked)
+    assert torch.isclose(marg, marg2, atol=1e-5).all()
+
+
+@given(data(), integers(min_value=1, max_value=10))
+@settings(max_examples=50, deadline=None)
+def test_cky_prune(data, seed):
+    torch.manual_seed(seed)
+    (terms, rules, roots), (batch, N) = CKY._rand()
+    NT, S = rules.shape[1], rules.shape[2]
+    factors = tuple((torch.rand(batch, n, 2) for n in (NT, S, S)))
+    dense = CKY.rank_rules(*factors)
+    keep = torch.rand(batch, N, N) > 0.3
+    keep[:, 0] = True
+
+    struct = CKY(LogSemiring, keep=keep)
+    alpha = struct.sum((terms, factors, roots))
+    count = struct.sum((terms, dense, roots))
+    assert torch.isclose(alpha, count).all()
+
+    # Pruned spans have no marginal mass.
+    marg = struct.marginals((terms, dense, roots))
+    for w in range(1, N):
+        pruned = ~keep.diagonal(w, 1, 2)
+        assert (marg[3][:, w - 1, : N - w][pruned] == 0).all()
+
+    alpha = CKY(LogSemiring, keep=torch.ones(batch, N, N).bool())
+    count = CKY(LogSemiring)
+    vals = (terms, rules, roots)
+    assert torch.isclose(alpha.sum(vals), count.sum(vals)).all()
+
+    # A bracketing with no span of width N - 1 leaves a width step with no
+    # kept spans. The best tree inside it is still scored by its parts.
+    if N < 4:
+        return
+    vals = tuple((v[:1] for v in vals))
+    tree = torch.zeros(1, N, N).bool()
+    tree[:, 0, 1] = tree[:, 0, N - 1] = True
+    for i in range(2, N - 1):
+        tree[:, i, N - 1] = True
+    struct = CKY(MaxSemiring, keep=tree)
+    v = struct.sum(vals)
+    marg = struct.marginals(vals)
+    score = sum(((m * x).sum() for m, x in zip(marg, vals)))
+    assert torch.isclose(v, score).all()
+
+
+@given(data(), integers(min_value=1, max_value=10))
+@settings(max_examples=50, deadline=None)
+def test_cky_sparse(data, seed):
+    semiring = data.draw(sampled_from([LogSemiring, MaxSemiring]))
+    torch.manual_seed(seed)
+    (terms, rules, roots), (batch, N) = CKY._rand()
+    NT = rules.shape[1]
+    mask = torch.rand(rules.shape[1:]) > 0.5
+    mask[:, NT:], mask[:, :, NT:] = True, True
+    parent, left, right = mask.nonzero(as_tuple=True)
+    sparse = (parent, left, right, rules[:, parent, left, right])
+    dense = rules.masked_fill(~mask, -1e9)
+    struct = CKY(semiring)
+
+    alpha = struct.sum((terms, sparse, roots))
+    count = struct.sum((terms, dense, roots))
+    assert torch.isclose(alpha, count).all()
+
+    marg = struct.marginals((terms, sparse, roots))
+    marg2 = struct.marginals((terms, dense, roots))
+    assert torch.isclose(marg[1][3], marg2[1][:, parent, left, right]).all()
+    for i in (0, 2, 3):
+        assert torch.isclose(marg[i], marg2[i], atol=1e-5).all()
+
+
+@given(data(), integers(min_value=1, max_value=10))
+@settings(max_examples=50, deadline=None)
+def test_decode(data, seed):
+    torch.manual_seed(seed)
+    vals, (batch, N) = CKY_CRF._rand()
+    lengths = torch.tensor(
+        [data.draw(integers(min_value=2, max_value=N)) for b in range(batch - 1)] + [N]
+    )
+    W = data.draw(integers(min_value=1, max_value=N))
+    struct = CKY_CRF(MaxSemiring, max_width=W)
+
+    # Backpointer spans match the argmax marginals.
+    spans = struct.decode(vals, lengths)
+    b, k = (spans[..., 0] >= 0).nonzero(as_tuple=True)
+    start, end, label = spans[b, k].unbind(-1)
+    event = torch.zeros_like(vals)
+    event[b, start, end, label] = 1
+    assert (torch.bincount(b, minlength=batch) == 2 * lengths - 1).all()
+    assert (event == struct.marginals(vals, lengths)).all()
+
+    # MBR decoding is the argmax over the marginals.
+    marg = CKY_CRF(max_width=W).marginals(vals, lengths)
+    spans = struct.decode(marg, lengths)
+    b, k = (spans[..., 0] >= 0).nonzero(as_tuple=True)
+    start, end, label = spans[b, k].unbind(-1)
+    event = torch.zeros_like(vals)
+    event[b, start, end, label] = 1
+    assert (event == struct.marginals(marg, lengths)).all()
+
+
+@given(data(), integers(min_value=1, max_value=10))
+@settings(max_examples=50, deadline=None)
+def test_cky_decode(data, seed):
+    torch.manual_seed(seed)
+    vals, (batch, N) = CKY._rand()
+    lengths = torch.tensor(
+        [data.draw(integers(min_value=2, max_value=N)) for b in range(batch - 1)] + [N]
+    )
+    W = data.draw(integers(min_value=1, max_value=N))
+    NT = vals[2].shape[-1]
+    struct = CKY(MaxSemiring, max_width=W)
+
+    spans = struct.decode(vals, lengths)
+    marg = struct.marginals(vals, lengths)
+    b, k = (spans[..., 0] >= 0).nonzero(as_tuple=True)
+    start, end, label = spans[b, k].unbind(-1)
+    term = start == end
+    terms = torch.zeros_like(marg[0])
+    terms[b[term], start[term], label[term] - NT] = 1
+    assert (terms == marg[0]).all()
+    nonterm = ~term
+    span_marg = torch.zeros_like(marg[3])
+    width = end[nonterm] - start[nonterm]
+    span_marg[b[nonterm], width - 1, start[nonterm], label[nonterm]] = 1
+    assert (span_marg == marg[3]).all()
+
+
+@given(integers(min_value=1, max_value=10))
+@settings(max_examples=50, deadline=None)
+def test_cky_prefix(seed):
+    torch.manual_seed(seed)
+    (terms, rules, roots), (batch, N) = CKY._rand()
+    NT, T = roots.shape[-1], terms.shape[-1]
+
+    # A proper PCFG, consistent by making nonterminal children unlikely.
+    rules[:, :, :NT] -= 5
+    rules[:, :, NT:, :NT] -= 5
+    rules = rules.view(batch, NT, -1).log_softmax(-1).view_as(rules)
+    roots, terms = roots.log_softmax(-1), terms.log()
+    struct = CKY()
+    prefixes = struct.prefixes((terms, rules, roots))
+
+    # p(x_1..x_j ...) = p(x_1..x_j) + sum_v p(x_1..x_j v ...)
+    for j in range(2, N + 1):
+        extended = torch.cat([terms[:, :j], torch.zeros(batch, 1, T)], dim=1)
+        ext = struct.prefixes((extended, rules, roots))
+        assert torch.isclose(ext[:, :j], prefixes[:, :j]).all()
+        log_Z = struct.sum((terms[:, :j], rules, roots))
+        total = torch.logaddexp(log_Z, ext[:, j])
+        assert torch.isclose(total, prefixes[:, j - 1], atol=1e-4).all()
+
+    # Prefixes of shorter sentences do not depend on the padding.
+    lengths = torch.randint(1, N + 1, (batch,))
+    padded = struct.prefixes((terms, rules, roots), lengths)
+    for b, n in enumerate(lengths.tolist()):
+        assert torch.isclose(padded[b, :n], prefixes[b, :n]).all()
+        assert (padded[b, n:] == 0).all()
+
+
+@given(data(), integers(min_value=1, max_value=10))
+@settings(max_examples=50, deadline=None)
+def test_expected_counts(data, seed):
+    torch.manual_seed(seed)
+    (terms, rules, roots), (batch, N) = CKY._rand()
+    NT, T = roots.shape[-1], terms.shape[-1]
+    V = data.draw(integers(min_value=1, max_value=5))
+    emit = torch.rand(T, V).log_softmax(-1)
+    rules = rules[0].view(NT, -1).log_softmax(-1).view_as(rules[0])
+    roots = roots[0].log_softmax(-1)
+    counts = ExpectedCounts(emit, rules, roots)
+    total, marg = 0, [0, 0, 0]
+    for _ in range(2):
+        words = torch.randint(V, (batch, N))
+        lengths = torch.tensor(
+            [data.draw(integers(min_value=2, max_value=N)) for b in range(batch - 1)]
+            + [N]
+        )
+        total = total + counts.add(words, lengths).sum()
+
+        # Batch-summed marginals of the same grammar.
+        scores = (
+            emit[:, words].permute(1, 2, 0).clone(),
+            rules.expand(batch, *rules.shape).clone(),
+            roots.expand(batch, NT).clone(),
+        )
+        term, rule, root = CKY().marginals(scores, lengths)[:3]
+        one_hot = torch.nn.functional.one_hot(words, V).type_as(term)
+        term = torch.einsum("bnt,bnv->tv", term, one_hot)
+        marg = [a + m for a, m in zip(marg, (term, rule.sum(0), root.sum(0)))]
+    for c, m in zip(counts.counts, marg):
+        assert torch.isclose(c, m, atol=1e-4).all()
+    assert torch.isclose(counts.log_likelihood, total)
+
+    # The update is a normalized grammar.
+    emit, rules, roots = counts.update(smooth=0.1)
+    assert torch.isclose(emit.logsumexp(-1), torch.tensor(0.0), atol=1e-5).all()
+    assert torch.isclose(
+        rules.view(NT, -1).logsumexp(-1), torch.tensor(0.0), atol=1e-5
+    ).all()
+    assert torch.isclose(roots.logsumexp(-1), torch.tensor(0.0), atol=1e-5)
+
+
+@given(data(), integers(min_value=1, max_value=10))
+@settings(max_examples=50, deadline=None)
+def test_deptree_decode(data, seed):
+    torch.manual_seed(seed)
+    vals, (batch, N) = DepTree._rand()
+    lengths = torch.tensor(
+        [data.draw(integers(min_value=1, max_value=N)) for b in range(batch - 1)] + [N]
+    )
+    struct = DepTree(MaxSemiring)
+
+    # Backpointer heads match the argmax marginals.
+    heads = struct.decode(vals, lengths)
+    event = DepTree.to_parts(heads, lengths=lengths).type_as(vals)
+    assert (event == struct.marginals(vals, lengths)).all()
+
+    # MBR decoding is the argmax over the marginals.
+    marg = DepTree().marginals(vals, lengths)
+    event = DepTree.to_parts(struct.decode(marg, lengths), lengths=lengths)
+    assert (event.type_as(vals) == struct.marginals(marg, lengths)).all()
+
+
 @given(data())
 @settings(max_examples=50, deadline=None)
 def test_generic_a(data):
@@ -406,6 +817,140 @@ def test_alignment(data):
     alpha = struct.sum(vals)
 
 
+@given(data(), integers(min_value=1, max_value=10))
+@settings(max_examples=50, deadline=None)
+def test_alignment_wavefront(data, seed):
+    torch.manual_seed(seed)
+    semiring = data.draw(sampled_from([StdSemiring, LogSemiring, MaxSemiring]))
+    struct = Alignment(semiring, engine="wavefront")
+    vals, (batch, N) = Alignment._rand()
+    alpha = struct.sum(vals)
+    count = struct.enumerate(vals)[0]
+    assert torch.isclose(count, alpha).all()
+
+    # Marginals of the ChartDP backward match the scan.
+    m = Alignment(engine="wavefront", checkpoint=2).marginals(vals)
+    m2 = Alignment().marginals(vals)
+    assert torch.isclose(m, m2, atol=1e-5).all()
+
+    M = vals.shape[2]
+    lengths = torch.tensor([N] + [data.draw(integers(1, N))] * (batch - 1))
+    alpha = Alignment(engine="wavefront", max_gap=M - 1).sum(vals, lengths)
+    for b in range(batch):
+        count = Alignment().enumerate(vals[b : b + 1, : lengths[b]])[0]
+        assert torch.isclose(count, alpha[b]).all()
+
+    vals = vals.detach().clone()
+    vals[..., 0] = -2 * vals[..., 0].abs()
+    vals[..., 2] = -2 * vals[..., 2].abs()
+    struct = Alignment(MaxSemiring, local=True, engine="wavefront")
+    alpha = struct.sum(vals)
+    diag = vals[:, torch.arange(N), torch.arange(N), 1].abs()
+    assert (alpha >= diag.max(-1)[0] - 1e-5).all()
+    assert (alpha >= diag.sum(-1) - 1e-5).all()
+    m = struct.marginals(vals)
+    assert torch.isclose(alpha, struct.score(vals, m)).all()
+
+    # The scan agrees on local alignment.
+    vals = -torch.rand(batch, data.draw(integers(1, 8)), data.draw(integers(1, 8)), 3)
+    vals[..., 1] = -vals[..., 1]
+    scan = Alignment(MaxSemiring, local=True)
+    assert torch.isclose(scan.sum(vals), struct.sum(vals)).all()
+    assert torch.isclose(scan.marginals(vals), struct.marginals(vals)).all()
+
+    # Local alignments of a single row are its single matches.
+    alpha = Alignment(LogSemiring, local=True).sum(vals[:, :1])
+    assert torch.isclose(alpha, vals[:, 0, :, 1].logsumexp(-1)).all()
+
+
+@given(data(), integers(min_value=1, max_value=10))
+@settings(max_examples=50, deadline=None)
+def test_alignment_ragged(data, seed):
+    torch.manual_seed(seed)
+    engine = data.draw(sampled_from(["scan", "wavefront"]))
+    batch, N, M = 3, 4, 4
+    vals = torch.rand(batch, N, M, 3)
+    ns = [data.draw(integers(2, N)) for _ in range(batch)]
+    ms = [data.draw(integers(2, M)) for _ in range(batch)]
+    lengths = torch.tensor([ns, ms]).t()
+
+    struct = Alignment(engine=engine)
+    alpha = struct.sum(vals, lengths)
+    m = struct.marginals(vals, lengths)
+    for b in range(batch):
+        pair = vals[b : b + 1, : ns[b], : ms[b]]
+        count = struct.enumerate(pair)[0]
+        assert torch.isclose(count, alpha[b]).all()
+        m2 = struct.marginals(pair)
+        assert torch.isclose(m[b, : ns[b], : ms[b]], m2[0], atol=1e-5).all()
+        assert (m[b, ns[b] :] == 0).all() and (m[b, :, ms[b] :] == 0).all()
+
+    # Pairs of very different lengths, and lengths shorter than N.
+    vals = torch.rand(batch, 2, 14, 3)
+    pairs = torch.tensor([[2, 14], [1, 12], [2, 3]])
+    alpha = struct.sum(vals, pairs)
+    short = struct.sum(vals, pairs[:, 0])
+    for b, (n, m) in enumerate(pairs.tolist()):
+        count = struct.enumerate(vals[b : b + 1, :n, :m])[0]
+        assert torch.isclose(count, alpha[b]).all()
+        count = struct.enumerate(vals[b : b + 1, :n])[0]
+        assert torch.isclose(count, short[b]).all()
+
+
+@given(data(), integers(min_value=1, max_value=10))
+@settings(max_examples=50, deadline=None)
+def test_alignment_decode(data, seed):
+    torch.manual_seed(seed)
+    local = data.draw(sampled_from([False, True]))
+    vals, (batch, N) = Alignment._rand()
+    if local:
+        vals[..., 0] = -2 * vals[..., 0].abs()
+        vals[..., 2] = -2 * vals[..., 2].abs()
+    struct = Alignment(MaxSemiring, local=local, engine="wavefront")
+    path, score = struct.decode(vals)
+    assert torch.isclose(score, struct.sum(vals)).all()
+
+    M = vals.shape[2]
+    for b in range(batch):
+        cells = path[b][path[b, :, 0] >= 0]
+        i, j, op = cells.t()
+        assert torch.isclose(vals[b, i, j, op].sum(), score[b])
+        assert op[0] == 1
+        assert ((i[1:] - i[:-1]) == (op[1:] >= 1).long()).all()
+        assert ((j[1:] - j[:-1]) == (op[1:] <= 1).long()).all()
+        if not local:
+            assert (i[0], j[0], i[-1], j[-1]) == (0, 0, N - 1, M - 1)
+        else:
+            assert op[-1] == 1
+
+
+@given(data(), integers(min_value=1, max_value=10))
+@settings(max_examples=50, deadline=None)
+def test_ctc(data, seed):
+    torch.manual_seed(seed)
+    vals, (batch, T) = CTC._rand()
+    V = vals.shape[-1]
+    targets, target_lengths, lengths = ctc_targets(data, batch, T, V)
+
+    semiring = data.draw(sampled_from([LogSemiring, MaxSemiring]))
+    struct = CTC(semiring, targets, target_lengths)
+    alpha = struct.sum(vals, lengths)
+    count = struct.enumerate(vals, lengths)[0]
+    assert torch.isclose(count, alpha).all()
+
+    # Partition is the negated CTC loss.
+    struct = CTC(LogSemiring, targets, target_lengths, checkpoint=2)
+    loss = torch.nn.functional.ctc_loss(
+        vals.transpose(0, 1), targets, lengths, target_lengths, reduction="none"
+    )
+    assert torch.isclose(struct.sum(vals, lengths), -loss, atol=1e-5).all()
+
+    m = struct.marginals(vals, lengths)
+    for b in range(batch):
+        assert torch.isclose(m[b, : lengths[b]].sum(-1), torch.tensor(1.0)).all()
+        assert (m[b, lengths[b] :] == 0).all()
+
+
 def test_hmm():
     C, V, batch, N = 5, 20, 2, 5
     transition = torch.rand(C, C)
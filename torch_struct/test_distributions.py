@@ -1,6 +1,9 @@
-from .distributions import LinearChainCRF
+from .distributions import LinearChainCRF, CTCCRF
 from .autoregressive import Autoregressive
-from .semirings import KMaxSemiring
+from .linearchain import LinearChain
+from .semirings import KMaxSemiring, EntropySemiring
+from .semirings.semirings import matmul
+from .test_utils import ctc_targets
 import torch
 from hypothesis import given, settings
 from hypothesis.strategies import integers, data, sampled_from
@@ -47,6 +50,34 @@ def test_simple(data, seed):
     assert ((samples.mean(0) - marginals).abs() < 0.2).all()
 
 
+@given(data(), integers(min_value=1, max_value=20))
+@settings(max_examples=50, deadline=None)
+def test_ctc(data, seed):
+    torch.manual_seed(seed)
+    vals, (batch, T) = CTCCRF.struct._rand()
+    targets, target_lengths, lengths = ctc_targets(data, batch, T, vals.shape[-1])
+
+    dist = CTCCRF(vals, targets, lengths, target_lengths)
+    edges, enum_lengths = dist.enumerate_support()
+    log_probs = dist.log_prob(edges)
+    for b in range(batch):
+        log_probs[enum_lengths[b] :, b] = -1e9
+
+    assert torch.isclose(log_probs.exp().sum(0), torch.tensor(1.0)).all()
+
+    entropy = dist.entropy
+    assert torch.isclose(
+        entropy, -log_probs.exp().mul(log_probs).sum(0), atol=1e-5
+    ).all()
+
+    _, max_indices = log_probs.max(0)
+    amax = edges[max_indices, torch.arange(batch)]
+    assert (amax == dist.argmax).all()
+
+    samples = dist.sample((100,))
+    assert ((samples.mean(0) - dist.marginals).abs() < 0.2).all()
+
+
 @given(data(), integers(min_value=1, max_value=20))
 @settings(max_examples=50, deadline=None)
 def test_autoregressive(data, seed):
@@ -66,7 +97,7 @@ def test_autoregressive(data, seed):
     class Model(torch.nn.Module):
         def forward(self, inputs, state):
             if inputs.shape[1] == 1:
-                state, = state
+                (state,) = state
                 in_batch, hidden = state.shape
                 t = state[0, 0]
                 batch = values.shape[0]
@@ -194,3 +225,27 @@ def test_ar2():
     dist = Autoregressive(AR(), init, C, N)
     dist.greedy_max()
     dist.beam_topk(5)
+
+
+class _GenericEntropy(EntropySemiring):
+    @classmethod
+    def matmul(cls, a, b):
+        return matmul(cls, a, b)
+
+
+@given(data(), integers(min_value=1, max_value=20))
+@settings(max_examples=50, deadline=None)
+def test_entropy_lengths_grad(data, seed):
+    torch.manual_seed(seed)
+    vals, (batch, N) = LinearChainCRF.struct._rand()
+    lengths = torch.tensor(
+        [data.draw(integers(min_value=2, max_value=N)) for b in range(batch - 1)] + [N]
+    )
+    vals.requires_grad_(True)
+
+    entropy = LinearChainCRF(vals, lengths).entropy
+    (g1,) = torch.autograd.grad(entropy.sum(), (vals,))
+    entropy2 = LinearChain(_GenericEntropy).sum(vals, lengths)
+    (g2,) = torch.autograd.grad(entropy2.sum(), (vals,))
+    assert torch.isclose(entropy, entropy2, atol=1e-5).all()
+    assert torch.isclose(g1, g2, atol=1e-4).all()
@@ -0,0 +1,13 @@
+import torch
+from hypothesis.strategies import integers
+
+
+def ctc_targets(data, batch, T, V):
+    "Draw CTC targets, target lengths and input lengths for *batch x T x V*."
+    L = data.draw(integers(1, (T - 1) // 2))
+    targets = torch.randint(1, V, (batch, L))
+    target_lengths = torch.tensor([data.draw(integers(0, L)) for _ in range(batch)])
+    lengths = torch.tensor(
+        [data.draw(integers(2 * tl.item() + 1, T)) for tl in target_lengths]
+    )
+    return targets, target_lengths, lengths